@@ -14,17 +14,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import time
 
 import internetarchive
 
 from . import BALVERSION
 import common
+from config import BALConfig
 from exception import IncorrectUsage
 import message
 
 
 class BALArchiver(object):
+    # Cache of the file lists of items, shared between instances
+    filelists = {}
+    # The number of seconds before a cached file list expires
+    filelistexpiry = 60
+    # The buffer size in bytes for reading files to upload
+    readbuffer = 4*1024*1024
+
     def __init__(self, identifier='', retries=3, debug=False, verbose=False):
         """
         This module is used for providing regular functions used for
@@ -68,6 +77,11 @@ class BALArchiver(object):
         Returns: List of files in the item excluding default files in
         alphabetical order. False if an error has occurred.
         """
+        cached = self.filelists.get(self.identifier)
+        if (cached is not None and
+                time.time() - cached[0] < self.filelistexpiry):
+            return list(cached[1])
+
         tries = 0
         while tries < self.retries:
             try:
@@ -87,7 +101,60 @@ class BALArchiver(object):
                 continue
             else:
                 filelist.append(filename)
-        return sorted(filelist)
+        filelist.sort()
+        self.filelists[self.identifier] = (time.time(), filelist,
+                                           frozenset(filelist))
+        return list(filelist)
+
+    def getFileSet(self):
+        """
+        This function is used to get the files in an item for checking if
+        files are in the item, without going through the whole list for each
+        file.
+
+        Returns: Frozenset of files in the item excluding default files, empty
+        if an error has occurred.
+        """
+        filelist = self.getFileList()
+        if (filelist is False):
+            return frozenset()
+        cached = self.filelists.get(self.identifier)
+        if (cached is None):
+            # The cache has been cleared by an upload in the meantime
+            return frozenset(filelist)
+        return cached[2]
+
+    def itemExists(self):
+        """
+        This function is used to check if the item exists on the Internet
+        Archive.
+
+        Returns: True if the item exists, False if otherwise or if an error
+        has occurred.
+        """
+        try:
+            iaitem = internetarchive.get_item(identifier=self.identifier)
+            return iaitem.exists
+        except Exception as exception:
+            self.handleException(exception=exception)
+            return False
+
+    def waitForItem(self, timeout=30, interval=2):
+        """
+        This function is used to wait for the Internet Archive to process the
+        creation of the item.
+
+        - timeout (int): The maximum number of seconds to wait for.
+        - interval (int): The number of seconds between each check.
+
+        Returns: True if the item exists, False if the timeout was reached.
+        """
+        start = time.time()
+        while not self.itemExists():
+            if (time.time() - start >= timeout):
+                return False
+            time.sleep(interval)
+        return True
 
     def getMd5Sums(self, dumpfile):
         """
@@ -113,24 +180,32 @@ class BALArchiver(object):
         thefile = iaitem.get_files(dumpfile)
         return thefile.md5
 
-    def uploadFile(self, body, metadata={}, headers={}, queuederive=False,
-                   verify=True):
+    def uploadFile(self, body, metadata=None, headers={}, queuederive=False,
+                   verify=True, path=None):
         """
         This function will upload a single file to the item on the Internet
         Archive.
 
         - body (string or list): The path to the file(s) to upload.
-        - metadata (dict): The metadata for the Internet Archive item.
+        - metadata (dict): The metadata for the Internet Archive item, None
+        for no metadata.
         - headers (dict): The headers to send when sending the request.
         - queuederive (boolean): Whether or not to derive the item after the
         file is uploaded.
         - verify (boolean): Whether or not to verify that the file is uploaded.
+        - path (string): The directory containing the file, if body is only
+        the name of the file.
 
         Returns: True if the file is successfully uploaded, False if errors
         are encountered.
 
         TODO: Implement multipart uploading.
         """
+        filepath = None
+        if (path is not None):
+            filepath = os.path.join(path, body)
+        # Do not change the metadata given by the caller
+        metadata = dict(metadata or {})
         if not metadata.get('scanner'):
             scanner = 'Balchivist Python Library %s' % (BALVERSION)
             metadata['scanner'] = scanner
@@ -138,11 +213,21 @@ class BALArchiver(object):
         iaupload = internetarchive.upload
 
         while tries < self.retries:
+            fileobj = None
             try:
-                iaupload(identifier=self.identifier, files=body,
+                files = body
+                if (filepath is not None):
+                    # Read the file in large chunks instead of the default
+                    # buffer size, and keep its name in the item instead of
+                    # its full path
+                    fileobj = open(filepath, 'rb', self.readbuffer)
+                    files = {body: fileobj}
+                iaupload(identifier=self.identifier, files=files,
                          metadata=metadata, headers=headers,
                          queue_derive=queuederive, verbose=self.verbose,
                          verify=verify, debug=self.debug, retries=self.retries)
+                # The cached file list of the item is now outdated
+                self.filelists.pop(self.identifier, None)
                 return True
             except Exception as exception:
                 self.handleException(exception=exception)
@@ -151,6 +236,9 @@ class BALArchiver(object):
                 else:
                     tries += 1
                     time.sleep(60*tries)
+            finally:
+                if (fileobj is not None):
+                    fileobj.close()
 
     def modifyMetadata(self, metadata, target='metadata', append=False,
                        priority=None):
@@ -166,6 +254,8 @@ class BALArchiver(object):
 
         Returns: True if the modification is successful, False if otherwise.
         """
+        # Do not change the metadata given by the caller
+        metadata = dict(metadata)
         if not metadata.get('scanner'):
             scanner = 'Balchivist Python Library %s' % (BALVERSION)
             metadata['scanner'] = scanner
@@ -186,48 +276,57 @@ class BALArchiver(object):
                     tries += 1
                     time.sleep(60*tries)
 
-    def upload(self, body, metadata={}, headers={}, queuederive=False,
-               verify=True):
+    def upload(self, body, metadata=None, headers={}, queuederive=False,
+               verify=True, workers=4, path=None):
         """
         This function acts as a wrapper for the uploadFile function, but adds
         additional functionality to ensure better error handling.
 
         - body (string or list): The path to the file(s) to upload.
-        - metadata (dict): The metadata for the Internet Archive item.
+        - metadata (dict): The metadata for the Internet Archive item, None
+        for no metadata.
         - headers (dict): The headers to send when sending the request.
         - queuederive (boolean): Whether or not to derive the item after the
         file is uploaded.
         - verify (boolean): Whether or not to verify that the file is uploaded.
+        - workers (int): The number of files to upload concurrently after the
+        first file has created the item.
+        - path (string): The directory containing the files, if body only
+        contains the names of the files.
 
         Returns: True if process is successful, False if otherwise.
         """
-        count = 0
-        for dumpfile in body:
+        if not body:
+            return True
+
+        # Only the first file creates the item, so send the metadata with it
+        newitem = bool(metadata) and not self.itemExists()
+        self.common.giveMessage("Uploading file: %s" % (body[0]))
+        upload = self.uploadFile(body[0], metadata=metadata, headers=headers,
+                                 verify=verify, queuederive=queuederive,
+                                 path=path)
+        if upload:
+            self.common.giveDebugMessage(upload)
+        else:
+            return False
+
+        # Allow the Internet Archive to process the item creation
+        metadatawait = int(BALConfig('main').get('metadatawait', default=30))
+        if (newitem and metadatawait > 0 and not self.debug):
+            timenow = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            self.common.giveMessage("Waiting for the item to be created, "
+                                    "%s" % (timenow))
+            self.waitForItem(timeout=metadatawait)
+
+        def uploadRest(dumpfile):
             self.common.giveMessage("Uploading file: %s" % (dumpfile))
-            time.sleep(1)  # For Ctrl+C
-            if count == 0:
-                upload = self.uploadFile(dumpfile, metadata=metadata,
-                                         headers=headers, verify=verify,
-                                         queuederive=queuederive)
-                # Allow the Internet Archive to process the item creation
-                if self.debug:
-                    pass
-                else:
-                    timenow = time.strftime("%Y-%m-%d %H:%M:%S",
-                                            time.localtime())
-                    self.common.giveMessage("Sleeping for 30 seconds, %s" %
-                                            (timenow))
-                    time.sleep(30)
-            else:
-                upload = self.uploadFile(dumpfile, queuederive=queuederive,
-                                         verify=verify)
+            return self.uploadFile(dumpfile, metadata=None,
+                                   queuederive=queuederive, verify=verify,
+                                   path=path)
 
-            if upload:
-                self.common.giveDebugMessage(upload)
-                count += 1
-            else:
-                return False
-        return True
+        # The remaining files are independent of each other, but stop
+        # uploading them as soon as one fails
+        return self.common.parallelAll(uploadRest, body[1:], workers=workers)
 
 
 if __name__ == '__main__':
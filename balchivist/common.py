@@ -14,10 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import shutil
 import sys
-import urllib
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from exception import IncorrectUsage
 import config
@@ -25,6 +30,20 @@ import message
 
 
 class BALCommon(object):
+    linkregex = re.compile(r'<a href="(?P<link>[^"]+)">')
+    # Log files that have been opened, shared by all instances
+    logfiles = {}
+    # HTTP session shared by all instances, see getSession()
+    session = None
+    # Seconds to wait for connecting to and for reading from a server
+    timeout = (5, 60)
+    # Links from extractLinks keyed by URL, with the ETag and Last-Modified
+    # headers of the page so that it is only downloaded again if it changed
+    linkcache = {}
+    # The maximum number of pages in linkcache, which is cleared when full so
+    # that long-running processes do not keep growing
+    cachesize = 4096
+
     def __init__(self, verbose=False, debug=False, log=False):
         """
         This module is used for common functionality that even the package
@@ -35,6 +54,8 @@ class BALCommon(object):
         self.log = log
         BALConfig = config.BALConfig('main')
         self.logtofile = BALConfig.get('logfile')
+        self.downloadworkers = int(BALConfig.get('downloadworkers',
+                                                 default=4))
 
     def giveMessage(self, message):
         """
@@ -42,16 +63,16 @@ class BALCommon(object):
 
         - message (string): The message to give.
         """
+        if not (self.verbose or self.debug or self.log):
+            # The message would not be shown anywhere
+            return
+
         output = "%s\n" % (message)
         if (self.verbose):
             sys.stdout.write(output)
-        else:
-            pass
 
         if (self.debug):
             sys.stderr.write(output)
-        else:
-            pass
 
         self.logMessage(output)
 
@@ -64,11 +85,13 @@ class BALCommon(object):
 
         - message (string): The message to give.
         """
+        if not (self.debug or self.log):
+            # The message would not be shown anywhere
+            return
+
         output = "%s\n" % (message)
         if (self.debug):
             sys.stderr.write(output)
-        else:
-            pass
 
         self.logMessage(output)
 
@@ -90,11 +113,16 @@ class BALCommon(object):
 
         - message (string): The message to log.
         """
-        if (self.log):
-            with open(self.logtofile, "a") as logfile:
-                logfile.write(message)
-        else:
-            pass
+        if not (self.log):
+            return
+
+        logfile = self.logfiles.get(self.logtofile)
+        if (logfile is None):
+            # Keep the log file open instead of opening it for every message,
+            # line buffered so that each message is written in a single call
+            logfile = open(self.logtofile, "a", 1)
+            self.logfiles[self.logtofile] = logfile
+        logfile.write(message)
 
     def checkDumpDir(self, path, filelist):
         """
@@ -106,25 +134,42 @@ class BALCommon(object):
 
         Returns: True if the dump directory is complete, False if otherwise.
         """
-        if (os.path.exists(path)):
-            files = os.listdir(path)
-        else:
+        try:
+            files = set(os.listdir(path))
+        except OSError:
             # The dump directory does not exist, something wrong probably
             # happened along the way.
             self.giveDebugMessage("The dump file directory does not exist!")
             return False
 
-        for dumpfile in filelist:
-            if (dumpfile in files):
-                continue
-            else:
-                # The dump files on the local directory is incomplete.
-                # Exit the rest of the function and leave it to another day.
-                self.giveDebugMessage("The dump files in the local directory "
-                                      "is incomplete!")
-                self.giveDebugMessage("File missing is: %s" % (dumpfile))
-                return False
-        return True
+        if (files.issuperset(filelist)):
+            return True
+
+        # The dump files on the local directory is incomplete. Find the
+        # missing file for the debug message and leave it to another day.
+        missing = [dumpfile for dumpfile in filelist if dumpfile not in files]
+        self.giveDebugMessage("The dump files in the local directory is "
+                              "incomplete!")
+        self.giveDebugMessage("File missing is: %s" % (missing[0]))
+        return False
+
+    @classmethod
+    def getSession(cls):
+        """
+        This function is used to get the HTTP session shared by all instances
+        so that connections to the same server are reused.
+
+        Returns: A requests.Session instance.
+        """
+        if (cls.session is None):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16,
+                                  max_retries=Retry(total=3,
+                                                    backoff_factor=0.3))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls.session = session
+        return cls.session
 
     def extractLinks(self, url):
         """
@@ -142,24 +187,107 @@ class BALCommon(object):
         directory.
         """
         links = []
-        page = urllib.urlopen(url)
-        raw = page.read()
-        page.close()
-
-        regex = r'<a href="(?P<link>[^>]+)">'
-        m = re.compile(regex).finditer(raw)
-        for i in m:
-            link = i.group('link')
-            if (link == "../"):
-                # Skip the parent directory
-                continue
-            elif (link.endswith('/')):
-                links.append(link[:-1])
-            else:
-                links.append(link)
-        return sorted(links)
-
-    def downloadFiles(self, filelist, directory, baseurl):
+        headers = {}
+        cached = self.linkcache.get(url)
+        if (cached is not None):
+            etag, lastmodified = cached[0]
+            if (etag is not None):
+                headers['If-None-Match'] = etag
+            if (lastmodified is not None):
+                headers['If-Modified-Since'] = lastmodified
+
+        with self.getSession().get(url, headers=headers, stream=True,
+                                   timeout=self.timeout) as response:
+            if (cached is not None and response.status_code == 304):
+                # The page has not changed since it was last downloaded
+                return list(cached[1])
+            validators = (response.headers.get('etag'),
+                          response.headers.get('last-modified'))
+            # Directory listings have a link on each line, so go through the
+            # page a line at a time instead of reading all of it first
+            for line in response.iter_lines(decode_unicode=True):
+                for i in self.linkregex.finditer(line):
+                    link = i.group('link')
+                    if (link == "../"):
+                        # Skip the parent directory
+                        continue
+                    elif (link.endswith('/')):
+                        links.append(link[:-1])
+                    else:
+                        links.append(link)
+        links.sort()
+        if (response.status_code == 200 and validators != (None, None)):
+            if (len(self.linkcache) >= self.cachesize):
+                self.linkcache.clear()
+            self.linkcache[url] = (validators, links)
+        return list(links)
+
+    def downloadFile(self, thefile, directory, baseurl):
+        """
+        This function is used for downloading a single file of a dump into
+        the given directory, unless it has already been downloaded. A partial
+        download from an earlier attempt is continued instead of restarted.
+
+        - thefile (string): The name of the file to download.
+        - directory (string): The path to the directory that will store the
+        downloaded file.
+        - baseurl (string): The URL to the directory that contains the file.
+
+        Returns: True if the file has been downloaded, False if otherwise.
+        """
+        filepath = os.path.join(directory, thefile)
+        if (os.path.isfile(filepath)):
+            return True
+
+        self.giveMessage("Downloading file: %s" % (thefile))
+        fileurl = "%s/%s" % (baseurl, thefile)
+        # Only give the file its name once it is complete
+        partfile = "%s.part" % (filepath)
+        # The raw response is written to the file as it is, so the server
+        # must not compress it (which would also break continuing it)
+        headers = {
+            'Accept-Encoding': 'identity'
+        }
+        if (os.path.exists(partfile)):
+            existing = os.path.getsize(partfile)
+            headers['Range'] = 'bytes=%d-' % (existing)
+        else:
+            existing = 0
+        try:
+            with self.getSession().get(fileurl, headers=headers, stream=True,
+                                       timeout=self.timeout) as response:
+                if (response.status_code == 416):
+                    # The range starts at the end of the file on the server
+                    # if the partial file is already complete
+                    total = response.headers.get('content-range', '')
+                    if (total == 'bytes */%d' % (existing)):
+                        os.rename(partfile, filepath)
+                        return True
+                    # The partial file does not match the file on the server
+                    os.remove(partfile)
+                    return False
+                response.raise_for_status()
+                if (response.status_code != 206):
+                    # The server is sending the whole file
+                    existing = 0
+                with open(partfile, 'ab' if existing else 'wb') as output:
+                    shutil.copyfileobj(response.raw, output, 1024*1024)
+                size = os.path.getsize(partfile) - existing
+                expected = response.headers.get('content-length')
+            if (expected is not None and int(expected) != size):
+                # The connection was closed before the whole file was sent,
+                # keep what was sent for the next attempt
+                self.giveDebugMessage("File %s is incomplete!" % (thefile))
+                return False
+            os.rename(partfile, filepath)
+            return True
+        except Exception as exception:
+            # Keep the partial file so that the next attempt can continue it
+            self.giveDebugMessage("Unable to download %s: %s" % (thefile,
+                                                                 exception))
+            return False
+
+    def downloadFiles(self, filelist, directory, baseurl, workers=None):
         """
         This function is used for downloading all the files for a given dump
         into the given directory.
@@ -168,27 +296,77 @@ class BALCommon(object):
         - directory (string): The path to the directory that will store the
         downloaded files.
         - baseurl (string): The URL to the directory that contains the files.
-        """
-        fileopener = urllib.URLopener()
+        - workers (int): The number of files to download at the same time,
+        defaults to the "downloadworkers" setting.
 
-        if (os.path.exists(directory)):
-            pass
-        else:
+        Returns: True if all the files have been downloaded, False if
+        otherwise.
+        """
+        if (workers is None):
+            workers = self.downloadworkers
+        if not (os.path.exists(directory)):
             os.makedirs(directory)
 
-        os.chdir(directory)
-        for thefile in filelist:
-            if (os.path.isfile(thefile)):
-                continue
-            else:
-                self.giveMessage("Downloading file: %s" % (thefile))
-                fileurl = "%s/%s" % (baseurl, thefile)
-                try:
-                    fileopener.retrieve(fileurl, thefile)
-                except:
-                    # Remove the last file as it may be corrupted
-                    os.remove(thefile)
+        def download(thefile):
+            return self.downloadFile(thefile=thefile, directory=directory,
+                                     baseurl=baseurl)
+
+        return self.parallelAll(download, filelist, workers)
+
+    @staticmethod
+    def parallelMap(function, items, workers=16):
+        """
+        This function is used for calling the given function on every item
+        using a pool of threads. It is meant for network-bound work, such as
+        fetching many pages from the same server.
+
+        - function (function): The function to call with each item.
+        - items (list): The items to work on.
+        - workers (int): The maximum number of threads to use.
+
+        Returns: List with the results in the same order as the given items.
+        """
+        if not items:
+            return []
+        pool = ThreadPool(processes=min(workers, len(items)))
+        try:
+            # Waiting with a timeout allows KeyboardInterrupt to be raised
+            results = pool.map_async(function, items).get(60*60*24*7)
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        return results
+
+    @staticmethod
+    def parallelAll(function, items, workers=16):
+        """
+        This function is used for calling the given function on every item
+        using a pool of threads until one of the calls fails. Items that have
+        not been started when a call fails are skipped.
+
+        - function (function): The function to call with each item.
+        - items (list): The items to work on.
+        - workers (int): The maximum number of threads to use.
+
+        Returns: True if all calls returned a true value, False if otherwise.
+        """
+        if not items:
+            return True
+        pool = ThreadPool(processes=min(workers, len(items)))
+        try:
+            results = pool.imap_unordered(function, items)
+            for item in items:
+                # Waiting with a timeout allows KeyboardInterrupt to be raised
+                if not results.next(60*60*24*7):
+                    pool.terminate()
                     return False
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
         return True
 
     def checkDownloadFileExistence(self, fileurl):
@@ -202,8 +380,9 @@ class BALCommon(object):
         Returns: True if a resource exists in the given URL, False if
         otherwise.
         """
-        thefile = urllib.urlopen(fileurl)
-        if (thefile.getcode() == 200):
+        thefile = self.getSession().head(fileurl, allow_redirects=True,
+                                         timeout=self.timeout)
+        if (thefile.status_code == 200):
             return True
         else:
             return False
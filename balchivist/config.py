@@ -22,6 +22,9 @@ import message
 
 
 class BALConfig(object):
+    # Parsed configuration files, keyed by path, with their modification time
+    parsers = {}
+
     def __init__(self, section, configfile=None):
         """
         This module is for parsing configuration settings in a common
@@ -38,18 +41,42 @@ class BALConfig(object):
             self.configfile = configfile
         self.section = section
 
-    def get(self, variable):
+    def get(self, variable, default=None):
         """
         This function is used to get the value for a given configuration
         variable in a certain section.
 
         - variable (string): The variable in the section to get the value for.
+        - default (any): The value to return if the variable is not set. The
+        variable is required if this is None.
 
         Returns: Any type depending on the variable.
         """
+        config = self.getParser()
+        if (default is not None and
+                not config.has_option(self.section, variable)):
+            return default
+        return config.get(self.section, variable)
+
+    def getParser(self):
+        """
+        This function is used to get the parsed configuration file. The file
+        is only parsed again if it has been modified since it was last read.
+
+        Returns: SafeConfigParser object with the configuration file read.
+        """
+        try:
+            mtime = os.stat(self.configfile).st_mtime
+        except OSError:
+            mtime = None
+        cached = self.parsers.get(self.configfile)
+        if (cached is not None and cached[0] == mtime):
+            return cached[1]
+
         config = ConfigParser.SafeConfigParser()
         config.read(self.configfile)
-        return config.get(self.section, variable)
+        self.parsers[self.configfile] = (mtime, config)
+        return config
 
 
 if __name__ == '__main__':
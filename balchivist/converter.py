@@ -18,7 +18,8 @@ import datetime
 import json
 import os
 import time
-import urllib
+
+import requests
 
 from exception import IncorrectUsage
 import message
@@ -117,6 +118,17 @@ class BALConverter(object):
         "wb": "Wikimedia West Bengal"
     }
 
+    # The maximum number of entries in each cache before it is emptied, so
+    # that long-running processes do not keep growing
+    cachesize = 4096
+    # Dates that have already been converted by getDateFromWiki
+    datecache = {}
+    # Names that have already been worked out by getNameFromDB
+    namecache = {}
+    # Language names keyed by language code and when they were last loaded
+    langnames = {}
+    langloaded = 0
+
     def getLanguageList(self):
         """
         This function gets the language list from the English Wikipedia and
@@ -124,9 +136,11 @@ class BALConverter(object):
 
         Returns: Boolean to indicate status of the language list retrieval.
         """
-        fileopener = urllib.URLopener()
         try:
-            fileopener.retrieve(self.apiUrl, self.langFile)
+            response = requests.get(self.apiUrl, timeout=60)
+            response.raise_for_status()
+            with open(self.langFile, 'wb') as langfile:
+                langfile.write(response.content)
             return True
         except:
             return False
@@ -162,24 +176,31 @@ class BALConverter(object):
 
         Returns: String with the English name of the language, else False
         """
-        langname = False
-        languages = self.getLanguages()['sitematrix']
-        for key in languages.keys():
-            if key == 'count':
-                continue
-            elif code == languages[key]['code']:
-                langname = languages[key]['localname'].encode('utf8')
-                break
-            else:
-                continue
+        if (time.time() - self.langloaded >= 60*60*24*1):
+            # Build a lookup table of the languages, refreshed once a day
+            langnames = {}
+            languages = self.getLanguages()['sitematrix']
+            for key in languages.keys():
+                if key == 'count':
+                    continue
+                else:
+                    langcode = languages[key]['code']
+                    localname = languages[key]['localname']
+                    if not isinstance(localname, str):
+                        # Python 2 gives unicode objects from the JSON
+                        localname = localname.encode('utf8')
+                    langnames.setdefault(langcode, localname)
+            BALConverter.langnames = langnames
+            BALConverter.langloaded = time.time()
         # It is possible that the code is not found, return False directly
-        return langname
+        return self.langnames.get(code, False)
 
-    @staticmethod
-    def getDateFromWiki(date, archivedate=False):
+    @classmethod
+    def getDateFromWiki(cls, date, archivedate=False):
         """
         This function converts the date in the format %Y%m%d (e.g. 20150703)
-        into different date formats.
+        into different date formats. The results are cached since the same
+        dates are converted many times during a run.
 
         - date (string): The date in the format %Y%m%d
         - archivedate (boolean): Whether or not to get the archivedate format
@@ -187,12 +208,20 @@ class BALConverter(object):
         Returns: String with the date in either the %B %d, %Y format, or the
         %Y-%m-%d format (if archivedate is True)
         """
-        # If the date is in the wrong format, an exception will be thrown
-        d = datetime.datetime.strptime(date, '%Y%m%d')
-        if archivedate:
-            return d.strftime('%Y-%m-%d')
-        else:
-            return d.strftime('%B %d, %Y')
+        key = (date, archivedate)
+        # Another thread may clear the cache at any time, so only read it once
+        output = cls.datecache.get(key)
+        if (output is None):
+            # If the date is in the wrong format, an exception will be thrown
+            d = datetime.datetime.strptime(date, '%Y%m%d')
+            if archivedate:
+                output = d.strftime('%Y-%m-%d')
+            else:
+                output = d.strftime('%B %d, %Y')
+            if (len(cls.datecache) >= cls.cachesize):
+                cls.datecache.clear()
+            cls.datecache[key] = output
+        return output
 
     @staticmethod
     def getDateFromOsm(date, archivedate=False):
@@ -243,6 +272,34 @@ class BALConverter(object):
         Returns: String with the human-readable name of the database, or the
         original database name if it is not possible to be changed.
         """
+        key = (wikidb, pretext)
+        # Another thread may clear the cache at any time, so only read it once
+        names = cls.namecache.get(key)
+        if (names is None):
+            names = cls.parseDBName(wikidb, pretext=pretext)
+            if (len(cls.namecache) >= cls.cachesize):
+                cls.namecache.clear()
+            cls.namecache[key] = names
+        output, langname, project = names
+        if format == 'language':
+            return langname
+        elif format == 'project':
+            return project
+        else:
+            return output
+
+    @classmethod
+    def parseDBName(cls, wikidb, pretext=False):
+        """
+        This function works out the human-readable name, language and project
+        of a wiki database for getNameFromDB.
+
+        - wikidb (string): The wiki database name.
+        - pretext (boolean): Whether or not to prefix non-special wikis with
+        "the" (e.g. "the English Wikipedia").
+
+        Returns: Tuple with the human-readable name, language and project.
+        """
         output = wikidb
         langname = 'English'
         project = 'Wikimedia'
@@ -289,12 +346,7 @@ class BALConverter(object):
                         pass
                 else:
                     continue
-        if format == 'language':
-            return langname
-        elif format == 'project':
-            return project
-        else:
-            return output
+        return output, langname, project
 
 
 if __name__ == "__main__":
@@ -14,8 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
 import MySQLdb
+import os
 import socket
+import threading
 
 from config import BALConfig
 from exception import IncorrectUsage
@@ -28,6 +31,10 @@ class BALSqlDb(object):
     database and the regular functions specific to Balchivist.
     """
     hostname = socket.gethostname()
+    # Numbers for telling apart the batches claimed by popAndClaim
+    batches = itertools.count(1)
+    # The number of seconds to wait when connecting to the database server
+    connecttimeout = 10
 
     def __init__(self, database="balchivist", host="localhost", user="root", passwd=""):
         """
@@ -42,6 +49,8 @@ class BALSqlDb(object):
         self.host = host
         self.user = user
         self.passwd = passwd
+        # Each thread keeps its own connection to the database server
+        self.local = threading.local()
 
     @classmethod
     def getFromConf(cls):
@@ -55,19 +64,20 @@ class BALSqlDb(object):
                    user=config.get('user'),
                    passwd=config.get('passwd'))
 
-    def getConds(self, params):
+    def getParamConds(self, params):
         """
         This function is used for getting the conditions necessary for the
-        SQL query to work.
+        SQL query to work, with placeholders for the values so that they are
+        escaped by the database driver.
 
         - params (dict): A dictionary of the conditions to transform.
 
-        Returns: String with the SQL-like conditions.
+        Returns: Tuple with the SQL-like conditions and a tuple of the values
+        to substitute in them.
         """
-        conds = []
-        for cond in params:
-            conds.append('%s="%s"' % (cond, params[cond]))
-        return ' AND '.join(conds)
+        keys = sorted(params)
+        conds = ' AND '.join(['%s=%%s' % (key) for key in keys])
+        return conds, tuple([params[key] for key in keys])
 
     def claimItem(self, params, dbtable=None):
         """
@@ -86,10 +96,119 @@ class BALSqlDb(object):
         occurred.
         """
         vals = {
-            'claimed_by': '"%s"' % (self.hostname)
+            'claimed_by': self.getClaimToken()
         }
-        return self.update(dbtable=dbtable, values=vals,
-                           conds=self.getConds(params=params))
+        return self.updateItem(dbtable=dbtable, values=vals, params=params)
+
+    def popAndClaim(self, dbtable=None, columns=[], conds='', limit=1):
+        """
+        This function is used to claim a batch of items and get them back in
+        one go, so that other instances of Balchivist cannot get the same
+        items in between.
+
+        - dbtable (string): The name of the database table.
+        - columns (list): The column(s) to retrieve from the database.
+        - conds (string): Conditions (WHERE clauses) that only match the items
+        that have not been claimed.
+        - limit (int): The maximum number of items to claim.
+
+        Returns: Tuple with the SQL query results, None if empty set. Errors
+        from the database server are raised instead of being taken as an
+        empty set.
+        """
+        if (dbtable is None):
+            return None
+        # Each batch gets its own token so that only the items claimed here
+        # are returned, not those left over from earlier batches
+        token = "%s:%d" % (self.getClaimToken(), next(self.batches))
+        query = 'UPDATE %s SET claimed_by=%%s WHERE %s LIMIT %d;'
+        if (self.executeWrite(query % (dbtable, conds, limit),
+                              (token,)) == 0):
+            return None
+        # The columns may contain escaped placeholders, so they are not put
+        # through string formatting
+        query = ' '.join(['SELECT', ', '.join(columns), 'FROM', dbtable,
+                          'WHERE claimed_by=%s;'])
+        return self.execute(query, (token,))
+
+    def getClaimToken(self):
+        """
+        This function is used to get the value of the "claimed_by" column for
+        the items claimed by this process. It tells the claims of this process
+        apart from those of other processes on the same host. The batches
+        claimed by popAndClaim have this value followed by a batch number.
+
+        Returns: String with the host name and process ID.
+        """
+        return "%s:%d" % (self.hostname, os.getpid())
+
+    def releaseClaims(self, dbtable=None, keep=[]):
+        """
+        This function is used to release all items that are still claimed by
+        this process, so that other instances of Balchivist can work on them.
+
+        - dbtable (string): The name of the database table.
+        - keep (list): Dicts with information about the items that should
+        stay claimed, such as those that are still waiting for their marks to
+        be written.
+
+        Returns: True if update is successful, False if an error occurred.
+        """
+        if (dbtable is None):
+            return False
+        token = self.getClaimToken()
+        # Escape the wildcards of LIKE that may be in the host name
+        pattern = token.replace('\\', '\\\\').replace('%', '\\%')
+        pattern = pattern.replace('_', '\\_') + ':%'
+        conds = ['(claimed_by=%s OR claimed_by LIKE %s)']
+        vals = (token, pattern)
+        for params in keep:
+            itemconds, itemvals = self.getParamConds(params=params)
+            conds.append('NOT (%s)' % (itemconds))
+            vals += itemvals
+        query = 'UPDATE %s SET claimed_by=NULL WHERE %s;'
+        try:
+            self.executeWrite(query % (dbtable, ' AND '.join(conds)), vals)
+            return True
+        except:
+            return False
+
+    def getConnection(self):
+        """
+        This function is used to get a connection to the database server for
+        the current thread, reusing the previous one if it is still alive.
+
+        Returns: A MySQLdb connection.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if (conn is not None and self.local.pid == os.getpid()):
+            try:
+                conn.ping()
+                return conn
+            except MySQLdb.OperationalError:
+                # The server has closed the connection, so open a new one
+                self.close()
+
+        conn = MySQLdb.connect(host=self.host, db=self.database,
+                               user=self.user, passwd=self.passwd,
+                               connect_timeout=self.connecttimeout)
+        self.local.conn = conn
+        # A connection inherited from the parent process cannot be shared
+        self.local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """
+        This function is used to close the connection to the database server
+        of the current thread, if any.
+        """
+        conn = getattr(self.local, 'conn', None)
+        self.local.conn = None
+        if (conn is not None and self.local.pid == os.getpid()):
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
 
     def execute(self, query, params=()):
         """
@@ -103,18 +222,73 @@ class BALSqlDb(object):
         Returns: Tuple with the MySQL query results, else None if empty set.
         """
         result = ()
-        conn = MySQLdb.connect(host=self.host, db=self.database, user=self.user, passwd=self.passwd)
+        conn = self.getConnection()
         cursor = conn.cursor()
-        cursor.execute(query, params)
-        result = cursor.fetchall()
-        conn.commit()
-        cursor.close()
-        conn.close()
+        try:
+            cursor.execute(query, params)
+            result = cursor.fetchall()
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
         if result is None or result is ():
             return None
         else:
             return result
 
+    def executeWrite(self, query, params=()):
+        """
+        This function is used to execute a query that modifies the database
+        and find out how many rows it has changed.
+
+        - query (string): The query to execute on the database.
+        - params (tuple): Parameters to substitute in query to prevent SQL
+        injection attacks.
+
+        Returns: Int with the number of rows affected.
+        """
+        conn = self.getConnection()
+        cursor = conn.cursor()
+        try:
+            affected = cursor.execute(query, params)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return affected
+
+    def executeMany(self, query, rows, chunksize=500):
+        """
+        This function is used to execute a query on the database for many
+        rows of parameters at once. The rows are sent in chunks, with each
+        chunk in a single transaction.
+
+        - query (string): The query to execute on the database.
+        - rows (list): A list of tuples with the parameters to substitute in
+        the query, one tuple for each row.
+        - chunksize (int): The maximum number of rows in each chunk.
+
+        Returns: Int with the number of rows affected.
+        """
+        affected = 0
+        conn = self.getConnection()
+        cursor = conn.cursor()
+        try:
+            for start in range(0, len(rows), chunksize):
+                chunk = rows[start:start + chunksize]
+                affected += cursor.executemany(query, chunk)
+                conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return affected
+
     def count(self, dbtable=None, conds='', options='', params=()):
         """
         This function is used to get a count of the number of rows in the
@@ -165,7 +339,7 @@ class BALSqlDb(object):
         else:
             keys = []
             vals = []
-            for key, val in values.iteritems():
+            for key, val in values.items():
                 keys.append(key)
                 vals.append(val)
 
@@ -181,6 +355,35 @@ class BALSqlDb(object):
             except:
                 return False
 
+    def insertMany(self, dbtable=None, columns=[], rows=[]):
+        """
+        This function is used for inserting many new rows into the database
+        in a single transaction.
+
+        - dbtable (string): The database table to query from.
+        - columns (list): The columns to insert the values into.
+        - rows (list): A list of tuples with the values for each row, in the
+        same order as columns.
+
+        Returns: True if insert is successful, False if an error occurred.
+        """
+        if (dbtable is None):
+            return False
+        elif (rows == []):
+            return True
+        else:
+            query = [
+                'INSERT INTO', dbtable,
+                '(' + ', '.join(columns) + ')',
+                'VALUES', '(' + ', '.join(['%s'] * len(columns)) + ')'
+            ]
+            execute = ' '.join(query) + ';'
+            try:
+                self.executeMany(execute, rows)
+                return True
+            except:
+                return False
+
     def select(self, dbtable=None, columns=[], conds='', options='',
                params=()):
         """
@@ -231,7 +434,7 @@ class BALSqlDb(object):
             return False
         else:
             vals = []
-            for key, val in values.iteritems():
+            for key, val in values.items():
                 vals.append('%s=%s' % (key, val))
 
             query = [
@@ -250,6 +453,66 @@ class BALSqlDb(object):
             except:
                 return False
 
+    def updateMany(self, dbtable=None, columns=[], keys=[], rows=[]):
+        """
+        This function is used for updating many rows in the database in a
+        single transaction.
+
+        - dbtable (string): The database table to query from.
+        - columns (list): The columns to update.
+        - keys (list): The columns used to identify the rows to update.
+        - rows (list): A list of tuples with the new values for each row in
+        the same order as columns, followed by the values of keys.
+
+        Returns: True if update is successful, False if an error occurred.
+        """
+        if (dbtable is None):
+            return False
+        elif (rows == []):
+            return True
+        else:
+            query = [
+                'UPDATE', dbtable,
+                'SET', ', '.join(['%s=%%s' % (col) for col in columns]),
+                'WHERE', ' AND '.join(['%s=%%s' % (key) for key in keys])
+            ]
+            execute = ' '.join(query) + ';'
+            try:
+                self.executeMany(execute, rows)
+                return True
+            except:
+                return False
+
+    def updateItem(self, dbtable=None, values={}, params={}):
+        """
+        This function is used for updating an item in the database, passing
+        all values as parameters to the query.
+
+        - dbtable (string): The database table to query from.
+        - values (dict): A dictionary of columns and their new values, None
+        for NULL.
+        - params (dict): Information about the item to update.
+
+        Returns: True if update is successful, False if an error occurred.
+        """
+        if (dbtable is None):
+            return False
+        else:
+            keys = sorted(values)
+            conds, condvals = self.getParamConds(params=params)
+            query = [
+                'UPDATE', dbtable,
+                'SET', ', '.join(['%s=%%s' % (key) for key in keys]),
+                'WHERE', conds
+            ]
+            execute = ' '.join(query) + ';'
+            vals = tuple([values[key] for key in keys]) + condvals
+            try:
+                self.execute(execute, vals)
+                return True
+            except:
+                return False
+
 
 if __name__ == "__main__":
     BALMessage = message.BALMessage()
@@ -0,0 +1,4 @@
+-- Patch for adding a composite index on the "dumps" table covering the
+-- conditions used when picking an item to archive or check.
+
+CREATE INDEX pending ON dumps (claimed_by, is_archived, is_checked, progress, can_archive);
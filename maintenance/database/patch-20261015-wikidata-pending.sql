@@ -0,0 +1,5 @@
+-- Patch for adding a composite index on the "wikidata" table covering the
+-- conditions used when claiming a batch of items to archive or check, and
+-- when getting or releasing the items claimed by a process.
+
+CREATE INDEX pending ON wikidata (claimed_by, is_archived, can_archive, is_checked);
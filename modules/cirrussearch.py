@@ -142,7 +142,7 @@ class BALMCirrussearch(object):
         allfiles = self.getFiles(dumpdate)
         if self.resume:
             items = []
-            iafiles = iaitem.getFileList()
+            iafiles = iaitem.getFileSet()
             for dumpfile in allfiles:
                 if dumpfile in iafiles:
                     continue
@@ -242,7 +242,7 @@ class BALMCirrussearch(object):
         Returns: Int with number of items left to work with.
         """
         conds = ['claimed_by IS NULL']
-        for key, val in params.iteritems():
+        for key, val in params.items():
             conds.append('%s="%s"' % (key, val))
         return self.sqldb.count(dbtable=self.dbtable,
                                 conds=' AND '.join(conds))
@@ -412,7 +412,7 @@ class BALMCirrussearch(object):
 
         - alldumps (list): A list of all dumps.
         """
-        storeddumps = self.getDumpDates()
+        storeddumps = set(self.getDumpDates())
         for dump in alldumps:
             if (dump in storeddumps):
                 self.common.giveMessage("Dump on %s already in the database, "
@@ -433,8 +433,10 @@ class BALMCirrussearch(object):
         cannotarc = self.getDumpDates(can_archive=0)
         lastweek = datetime.datetime.now()
         lastweek -= datetime.timedelta(days=7)
+        cutoff = lastweek.strftime("%Y%m%d")
+        available = set(alldumps)
         for dump in cannotarc:
-            if (dump <= lastweek.strftime("%Y%m%d") and dump in alldumps):
+            if (dump <= cutoff and dump in available):
                 # The dump is now suitable to be archived
                 self.common.giveMessage("Updating can_archive for the dump "
                                         "on %s" % (dump))
@@ -451,8 +453,9 @@ class BALMCirrussearch(object):
         - alldumps (list): A list of all dumps.
         """
         canarc = self.getDumpDates(can_archive=1)
+        available = set(alldumps)
         for dump in canarc:
-            if (dump in alldumps):
+            if (dump in available):
                 continue
             else:
                 # The dump is now unable to be archived
@@ -492,8 +495,8 @@ class BALMCirrussearch(object):
             # The dump directory is not suitable to be used, exit the function
             return False
 
-        os.chdir(dumps)
-        upload = iaitem.upload(body=allfiles, metadata=md, headers=headers)
+        upload = iaitem.upload(body=allfiles, metadata=md, headers=headers,
+                               path=dumps)
 
         if (upload and path is None):
             self.removeFiles(allfiles)
@@ -514,7 +517,7 @@ class BALMCirrussearch(object):
         identifier = "cirrussearch-%s" % (dumpdate)
         iaitem = balchivist.BALArchiver(identifier=identifier,
                                         verbose=self.verbose, debug=self.debug)
-        iafiles = iaitem.getFileList()
+        iafiles = iaitem.getFileSet()
         self.common.giveMessage("Checking if all files are uploaded for the "
                                 "%s dump" % (dumpdate))
         for dumpfile in allfiles:
@@ -15,12 +15,17 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import email.utils
 import json
+import multiprocessing
 import os
+import random
 import re
 import shutil
+import subprocess
 import time
-import urllib
+
+import requests
 
 import balchivist
 
@@ -31,12 +36,17 @@ class BALMDumps(object):
     Wikimedia Foundation (available at <https://dumps.wikimedia.org>) to
     the Internet Archive.
     """
-    title = "Wikimedia database dump of %s on %s"
-    desc = "This is the full database dump of %s that is "
-    desc += "generated by the Wikimedia Foundation on %s."
-    subject = "wiki;dumps;data dumps;%s;%s;%s"
+    title = "Wikimedia database dump of {sitename} on {datename}"
+    desc = "This is the full database dump of {sitename} that is "
+    desc += "generated by the Wikimedia Foundation on {datename}."
+    subject = "wiki;dumps;data dumps;{wiki};{langname};{project}"
     # A size hint for the Internet Archive, currently set at 100GB
     sizehint = "107374182400"
+    headers = {
+        'x-archive-size-hint': sizehint
+    }
+    # The number of concurrent requests to make to the dumps server
+    workers = 16
 
     config = balchivist.BALConfig('dumps')
     conv = balchivist.BALConverter()
@@ -64,6 +74,42 @@ class BALMDumps(object):
         'sha1sums.json',
         'sha1sums.txt'
     ]
+    # Links to the dated dump directories in the directory listing of a wiki
+    dumpregex = re.compile(r'<a href="(\d{8})/">')
+    # Job statuses in dumpruninfo.json that count towards each progress
+    progressstatuses = frozenset(['in-progress', 'waiting'])
+    donestatuses = frozenset(['done', 'skipped'])
+    # The column and value to update for each mark given to an item
+    marks = {
+        'archived': ('is_archived', 1),
+        'failedarchive': ('is_archived', 2),
+        'checked': ('is_checked', 1),
+        'failedcheck': ('is_checked', 2)
+    }
+    # The marks to give an item after each job if it succeeded or failed
+    jobmarks = {
+        'archive': ('archived', 'failedarchive'),
+        'check': ('checked', 'failedcheck')
+    }
+    # Wikis with dumps that take much longer to archive than the rest
+    largewikis = ('enwiki', 'wikidatawiki', 'dewiki', 'commonswiki')
+    # The mode to run in and the error to give (if any) depending on whether
+    # the wiki and the date were given
+    runmodes = {
+        (False, False): ('continuous', None),
+        (False, True): ('error', "Error: Date was given but not the wiki!"),
+        (True, False): ('error', "Error: Wiki was given but not the date!"),
+        (True, True): ('single', None)
+    }
+    # The number of marks to buffer before writing them to the database
+    markbatch = 50
+    # The number of items to claim at a time for the "check" job
+    batchlimit = 500
+    # Dump files of completed dumps, keyed by (wiki, date). This is shared
+    # between instances since the files of a completed dump do not change.
+    dumpfiles = {}
+    # The file listing the wikis done by an update that has not completed
+    updateprogress = "update.progress"
 
     def __init__(self, params={}, sqldb=None):
         """
@@ -80,6 +126,11 @@ class BALMDumps(object):
         self.sqldb = sqldb
         self.common = balchivist.BALCommon(verbose=self.verbose,
                                            debug=self.debug)
+        # Reuse connections to the dumps server across requests
+        self.session = self.common.getSession()
+        # Marks that have yet to be written to the database
+        self.pendingmarks = {}
+        self.marksflushed = time.time()
 
     @classmethod
     def argparse(cls, parser=None):
@@ -106,6 +157,22 @@ class BALMDumps(object):
                            default=False, dest="dumpsresume",
                            help="Resume uploading a wiki dump instead of "
                            "restarting all over.")
+        group.add_argument("--dumps-workers", action="store", type=int,
+                           default=1, dest="dumpsworkers",
+                           help="The number of items to work on at the same "
+                           "time in continuous mode. Each archive job "
+                           "downloads a full dump, so mind the disk space.")
+        group.add_argument("--dumps-idle", action="store", type=int,
+                           default=0, dest="dumpsidle",
+                           help="The number of seconds to keep waiting for "
+                           "new items in continuous mode after running out "
+                           "of them.")
+        group.add_argument("--dumps-queue", action="store",
+                           choices=["small", "large"], dest="dumpsqueue",
+                           help="Only work on the dumps of the large wikis or "
+                           "only on the dumps of the other wikis in "
+                           "continuous mode, so that one does not hold up "
+                           "the other.")
 
     def getItemMetadata(self, wiki, dumpdate):
         """
@@ -134,11 +201,13 @@ class BALMDumps(object):
             "contributor": self.config.get('contributor'),
             "mediatype": self.config.get('mediatype'),
             "rights": self.config.get('rights'),
-            "subject": self.subject % (wiki, langname, project),
+            "subject": self.subject.format(wiki=wiki, langname=langname,
+                                           project=project),
             "date": arcdate,
             "licenseurl": self.config.get('licenseurl'),
-            "title": self.title % (sitename, datename),
-            "description": self.desc % (sitename, datename)
+            "title": self.title.format(sitename=sitename, datename=datename),
+            "description": self.desc.format(sitename=sitename,
+                                            datename=datename)
         }
         return metadata
 
@@ -194,10 +263,7 @@ class BALMDumps(object):
             return False
         reporturl = "%s/%s/%s/%s" % (self.config.get('dumps'), wiki, date,
                                      report)
-        f = urllib.urlopen(reporturl)
-
-        raw = f.read()
-        f.close()
+        raw = self.session.get(reporturl, timeout=30).content
         try:
             return json.loads(raw)
         except ValueError:
@@ -219,32 +285,23 @@ class BALMDumps(object):
         - "unknown": Unknown status. It is likely that such a dump does not
         exist.
         """
-        progress = 0
-        done = 0
-
         try:
             report = self.getDumpJson(wiki, date, "dumpruninfo")["jobs"]
         except TypeError:
             # self.getDumpJson returned a boolean, likely due to missing report
             return "unknown"
 
-        for job in report:
-            status = report[job]["status"]
-            if (status == "failed"):
-                # The dump has 1 failed file, forget about archiving this dump
-                return "error"
-            elif (status == "in-progress" or status == "waiting"):
-                progress += 1
-            elif (status == "done" or status == "skipped"):
-                done += 1
-            else:
-                # Return output in case a new status appears.
-                # We do not want to corrupt our database with false entries.
-                return "unknown"
-
-        if (progress > 0):
+        statuses = set(job["status"] for job in report.values())
+        if ("failed" in statuses):
+            # The dump has 1 failed file, forget about archiving this dump
+            return "error"
+        elif (statuses - self.progressstatuses - self.donestatuses):
+            # Return output in case a new status appears.
+            # We do not want to corrupt our database with false entries.
+            return "unknown"
+        elif (statuses & self.progressstatuses):
             return "progress"
-        elif (progress == 0 and done > 0):
+        elif (statuses & self.donestatuses):
             return "done"
         else:
             return "unknown"
@@ -259,10 +316,28 @@ class BALMDumps(object):
         Returns: True if process is successful, False if otherwise.
         """
         dblisturl = self.config.get(dblist.replace(".", ""))
+        tempfile = "%s.tmp" % (dblist)
+        headers = {}
+        if (os.path.exists(dblist)):
+            # Only download the dblist again if it has changed upstream
+            lastchange = os.stat(dblist).st_mtime
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                lastchange, usegmt=True)
         try:
-            urllib.urlretrieve(dblisturl, dblist)
+            with self.session.get(dblisturl, headers=headers, stream=True,
+                                  timeout=60) as response:
+                if (response.status_code == 304):
+                    # Mark the local copy as fresh for another day
+                    os.utime(dblist, None)
+                    return True
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(tempfile, 'wb') as dblistfile:
+                    shutil.copyfileobj(response.raw, dblistfile, 1024*1024)
+            # Only replace the cached copy once the download is complete
+            os.rename(tempfile, dblist)
             return True
-        except:
+        except (requests.RequestException, IOError, OSError):
             return False
 
     def getDatabases(self, dblist):
@@ -272,32 +347,36 @@ class BALMDumps(object):
 
         - dblist (string): The name of the dblist file.
 
-        Returns: True if process is successful, False if otherwise.
+        Returns: List of databases in the order of the dblist file.
         """
-        if not os.path.exists(dblist):
+        try:
+            lastchange = os.stat(dblist).st_mtime
+        except OSError:
+            lastchange = None
+        if (lastchange is None):
             self.getDBList(dblist)
-        else:
-            lastchange = os.path.getctime(dblist)
-            now = time.time()
-            dayago = now - 60*60*24*1
-            if (lastchange < dayago):
-                # The dblist cache is more than a day old, update it
-                self.getDBList(dblist)
-            else:
-                pass
-        databases = open(dblist, 'r').read().splitlines()
-        return sorted(databases)
+        elif (lastchange < time.time() - 60*60*24*1):
+            # The dblist cache is more than a day old, update it
+            self.getDBList(dblist)
+        with open(dblist, 'r') as dblistfile:
+            # Skip blank lines, such as a trailing newline at the end
+            return [line.strip() for line in dblistfile if line.strip()]
 
     def getDumpFiles(self, wiki, date):
         """
         This function is used to get a list of dump files from the dumps server
-        by using regular expressions.
+        by using regular expressions. The list for a completed dump is cached
+        so that it is only fetched once.
 
         - wiki (string): The wiki database to get a list of files for.
         - date (string): The date of the dump in %Y%m%d format.
 
         Returns: List of files, or an empty list if an error has occurred.
         """
+        if (wiki, date) in self.dumpfiles:
+            # Return a copy as callers may add files to the list
+            return list(self.dumpfiles[(wiki, date)])
+
         dumpfiles = []
 
         try:
@@ -325,7 +404,8 @@ class BALMDumps(object):
                     return []
             except KeyError:
                 return []
-        return sorted(dumpfiles + self.additional)
+        self.dumpfiles[(wiki, date)] = sorted(dumpfiles + self.additional)
+        return list(self.dumpfiles[(wiki, date)])
 
     def checkDumpExists(self, wiki, date):
         """
@@ -339,8 +419,10 @@ class BALMDumps(object):
         """
         dumpurl = "%s/%s/%s/dumpstatus.json" % (self.config.get('dumps'), wiki,
                                                 date)
-        f = urllib.urlopen(dumpurl)
-        if f.getcode() == 200:
+        # Only the status code is needed, so do not fetch the report itself
+        response = self.session.head(dumpurl, allow_redirects=True,
+                                     timeout=30)
+        if response.status_code == 200:
             return True
         else:
             return False
@@ -356,353 +438,412 @@ class BALMDumps(object):
         """
         dumps = []
         url = "%s/%s" % (self.config.get('dumps'), wiki)
-        f = urllib.urlopen(url)
-        raw = f.read()
-        f.close()
-
-        regex = r'<a href="(?P<dump>[^>]+)/">'
-        m = re.compile(regex).finditer(raw)
-        for i in m:
-            try:
-                datetime.datetime.strptime(i.group('dump'), '%Y%m%d')
-            except ValueError:
-                continue
-            dumps.append(i.group('dump'))
+        response = self.session.get(url, stream=True, timeout=30)
+        try:
+            # Scan the directory listing as it arrives instead of reading it
+            # into memory in full
+            for line in response.iter_lines(chunk_size=65536):
+                for dump in self.dumpregex.findall(line):
+                    # Only keep directories that look like a date in %Y%m%d
+                    # format
+                    if (1 <= int(dump[4:6]) <= 12 and
+                            1 <= int(dump[6:8]) <= 31):
+                        dumps.append(dump)
+        finally:
+            response.close()
         return sorted(dumps)
 
-    def getItemsLeft(self, job=None):
+    def getJobConds(self, job=None, queue=None):
         """
-        This function is used for getting the number of items left to be done
-        for a specific job.
-
-        Note: The "update" job should not be using this!
+        This function is used to get the conditions for the items that are
+        waiting to be worked on for a specific job.
 
-        - job (string): The job to obtain the count for.
+        - job (string): The job to get the conditions for.
+        - queue (string): "large" for only the dumps of the large wikis,
+        "small" for only the dumps of the other wikis, None for all dumps.
 
-        Returns: Int with the number of items left to work on.
+        Returns: List of SQL-like conditions, None if the job is not known.
         """
-        conds = {
-            'progress': 'done'
-        }
+        conds = ['claimed_by IS NULL']
         if (job is None or job == "archive"):
-            conds['is_archived'] = "0"
-            conds['can_archive'] = "1"
-            return self.getNumberOfItems(params=conds)
+            conds.extend([
+                'progress="done"',
+                'is_archived="0"',
+                'can_archive="1"'
+            ])
         elif (job == "check"):
-            conds['is_archived'] = "1"
-            conds['is_checked'] = "0"
-            return self.getNumberOfItems(params=conds)
+            conds.extend([
+                'is_archived="1"',
+                'is_checked="0"'
+            ])
         else:
-            return 0
-
-    def getRandomItem(self, job=None):
-        """
-        This function is used for getting a random item to work on for a
-        specific job.
+            return None
 
-        Returns: Dict with the information about the item to work on.
-        """
-        if (job is None or job == "archive"):
-            itemdetails = self.getRandomItemSql(archived=False)
-            output = {
-                'wiki': itemdetails['wiki'],
-                'date': itemdetails['date']
-            }
-        elif (job == "check"):
-            itemdetails = self.getRandomItemSql(archived=True)
-            output = {
-                'wiki': itemdetails['wiki'],
-                'date': itemdetails['date']
-            }
-        elif (job == "update"):
-            output = {
-                'wiki': None,
-                'date': None
-            }
-        else:
-            output = {}
-        return output
+        if (queue is not None):
+            wikis = ', '.join(['"%s"' % (wiki) for wiki in self.largewikis])
+            if (queue == "large"):
+                conds.append('wiki IN (%s)' % (wikis))
+            else:
+                conds.append('wiki NOT IN (%s)' % (wikis))
+        return conds
 
-    def getNumberOfItems(self, params={}):
+    def getPendingItems(self, job=None, limit=500, queue=None):
         """
-        This function is used to get the number of items left to work with.
+        This function is used to get a batch of items to work on for a
+        specific job in a single query.
 
-        - params (dict): The conditions to put in the WHERE clause.
+        - job (string): The job to get the items for.
+        - limit (int): The maximum number of items to get.
+        - queue (string): The queue to get the items from (see getJobConds).
 
-        Returns: Int with number of items left to work with.
+        Returns: List of dicts with the "wiki" and "date" of each item, in
+        random order.
         """
-        conds = ['claimed_by IS NULL']
-        for key, val in params.iteritems():
-            conds.append('%s="%s"' % (key, val))
-        return self.sqldb.count(dbtable=self.dbtable,
-                                conds=' AND '.join(conds))
+        items = []
+        conds = self.getJobConds(job=job, queue=queue)
+        if (conds is None):
+            return items
 
-    def getRandomItemSql(self, archived=False):
+        results = self.sqldb.select(dbtable=self.dbtable,
+                                    columns=['wiki', 'dumpdate'],
+                                    conds=' AND '.join(conds),
+                                    options='LIMIT %d' % (limit))
+        if results is not None:
+            for result in results:
+                items.append({
+                    'wiki': result[0],
+                    'date': result[1].strftime("%Y%m%d")
+                })
+        # Other instances may be working on the same batch, so try not to
+        # work on the items in the same order
+        random.shuffle(items)
+        return items
+
+    def popPendingItems(self, job=None, limit=500, queue=None):
         """
-        This function is used to get a random item to work on.
+        This function is used to claim a batch of items to work on for a
+        specific job and get them in the same step.
 
-        - archived (boolean): Whether or not to obtain a random item that is
-        already archived.
+        - job (string): The job to get the items for.
+        - limit (int): The maximum number of items to claim.
+        - queue (string): The queue to claim the items from (see
+        getJobConds).
 
-        Returns: Dict with the parameters to the archiving scripts.
+        Returns: List of dicts with the "wiki" and "date" of each item.
         """
-        output = {}
-        columns = ['wiki', 'dumpdate']
-        options = 'ORDER BY RAND() LIMIT 1'
-        conds = ['claimed_by IS NULL']
+        items = []
+        conds = self.getJobConds(job=job, queue=queue)
+        if (conds is None):
+            return items
 
-        if (archived):
-            extra = [
-                'is_archived="1"',
-                'is_checked="0"'
-            ]
-        else:
-            extra = [
-                'progress="done"',
-                'is_archived="0"',
-                'can_archive="1"'
-            ]
-        conds.extend(extra)
-
-        results = self.sqldb.select(dbtable=self.dbtable, columns=columns,
-                                    conds=' AND '.join(conds), options=options)
-        if results is None:
-            # This should not be triggered at all. Use self.getItemsLeft()
-            # to verify first before running this function.
-            output = {
-                'wiki': None,
-                'date': None
-            }
-        else:
+        try:
+            results = self.sqldb.popAndClaim(dbtable=self.dbtable,
+                                             columns=['wiki', 'dumpdate'],
+                                             conds=' AND '.join(conds),
+                                             limit=limit)
+        except Exception as exception:
+            # Do not mistake a database error for having no items left
+            self.common.giveMessage("Unable to claim items for the %s job: "
+                                    "%s" % (job, exception))
+            raise
+        if results is not None:
             for result in results:
-                output = {
+                items.append({
                     'wiki': result[0],
                     'date': result[1].strftime("%Y%m%d")
-                }
+                })
+        return items
 
-        return output
+    def getPendingBatches(self, job=None, limit=500, idle=0, queue=None):
+        """
+        This function is used to go through all the items that are waiting
+        to be worked on for a specific job, a batch at a time. The next batch
+        is only queried after the previous one has been worked on.
+
+        - job (string): The job to get the items for.
+        - limit (int): The maximum number of items in each batch.
+        - idle (int): The number of seconds to keep waiting for new items
+        after running out of them. The wait between each query doubles from
+        1 second up to 60 seconds.
+        - queue (string): The queue to get the items from (see getJobConds).
+
+        Returns: Generator of lists from popPendingItems (the items are
+        already claimed).
+        """
+        delay = 1
+        idled = 0
+        while True:
+            # Items claimed by this process stay claimed until their marks
+            # are written, so write them before claiming the next batch
+            self.flushMarks()
+            batch = self.popPendingItems(job=job, limit=limit, queue=queue)
+            if (batch != []):
+                delay = 1
+                idled = 0
+                yield batch
+            if (len(batch) == limit):
+                # There are likely to be more items left
+                continue
+            elif (idled >= idle):
+                # The last batch had all the items that were left
+                break
+            else:
+                wait = min(delay, idle - idled)
+                time.sleep(wait)
+                idled += wait
+                delay = min(delay * 2, 60)
 
-    def updateCanArchive(self, params, can_archive):
+    def getBatchLimit(self, job=None, workers=1):
         """
-        This function is used to update the status of whether a dump can be
-        archived.
+        This function is used to get the number of items to claim at a time
+        for a specific job. Archiving a dump can take hours, so only as many
+        items as there are workers are claimed and the rest are left for
+        other instances.
 
-        - params (dict): Information about the item with the keys "wiki" and
-        "dumpdate".
-        - can_archive (int): The new can_archive status to update to.
+        - job (string): The job to get the number of items for.
+        - workers (int): The number of items that are worked on at once.
 
-        Returns: True if update is successful, False if an error occurred.
+        Returns: Int with the maximum number of items in each batch.
         """
-        vals = {
-            'can_archive': '"%s"' % (can_archive)
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        if (job is None or job == "archive"):
+            return max(workers, 1)
+        else:
+            return self.batchlimit
 
-    def markArchived(self, params):
+    def queueMark(self, mark, params):
         """
-        This function is used to mark an item as archived after doing so.
+        This function is used to buffer a mark for an item, which will be
+        written to the database together with other marks by flushMarks.
 
+        - mark (string): The mark to give, one of the keys of self.marks.
         - params (dict): Information about the item with the keys "wiki" and
         "dumpdate".
+        """
+        self.pendingmarks.setdefault(mark, []).append(params)
 
-        Returns: True if update is successful, False if an error occurred.
+    def flushMarks(self, force=True):
         """
-        vals = {
-            'is_archived': '"1"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        This function is used to write all buffered marks to the database,
+        with one transaction for each type of mark. The claims on the items
+        are released at the same time.
+
+        - force (boolean): Whether or not to write the marks even if there
+        are fewer than self.markbatch of them and they were last written less
+        than a minute ago.
 
-    def markChecked(self, params):
+        Returns: True if update is successful, False if an error occurred.
         """
-        This function is used to mark an item as checked after doing so.
+        pending = sum([len(items) for items in self.pendingmarks.values()])
+        if (pending == 0):
+            return True
+        elif (not force and pending < self.markbatch and
+              time.time() - self.marksflushed < 60):
+            return True
 
-        - params (dict): Information about the item with the keys "wiki" and
-        "dumpdate".
+        status = True
+        # Copy the marks as they are removed from the dict along the way
+        for mark, items in list(self.pendingmarks.items()):
+            column, value = self.marks[mark]
+            rows = [(value, None, item['wiki'], item['dumpdate'])
+                    for item in items]
+            if (self.sqldb.updateMany(dbtable=self.dbtable,
+                                      columns=[column, 'claimed_by'],
+                                      keys=['wiki', 'dumpdate'], rows=rows)):
+                del self.pendingmarks[mark]
+            else:
+                status = False
+        self.marksflushed = time.time()
+        return status
+
+    def releaseClaims(self):
+        """
+        This function is used to release the items that are still claimed by
+        this instance but have not been worked on, such as the rest of a batch
+        when the job is interrupted. Items waiting for their marks to be
+        written stay claimed.
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_checked': '"1"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        keep = [item for items in self.pendingmarks.values()
+                for item in items]
+        return self.sqldb.releaseClaims(dbtable=self.dbtable, keep=keep)
 
-    def markFailedArchive(self, params):
+    def addNewItems(self, items):
         """
-        This function is used to mark an item as failed when archiving it.
+        This function is used to insert many new items into the database in a
+        single transaction.
 
-        - params (dict): Information about the item with the keys "wiki" and
-        "dumpdate".
+        - items (list): A list of dicts with information about each item with
+        the keys "wiki", "date" and "progress".
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_archived': '"2"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        columns = ['wiki', 'dumpdate', 'progress', 'can_archive',
+                   'is_archived', 'is_checked']
+        rows = []
+        for item in items:
+            arcdate = self.conv.getDateFromWiki(item['date'],
+                                                archivedate=True)
+            rows.append((item['wiki'], arcdate, item['progress'], 0, 0, 0))
+        return self.sqldb.insertMany(dbtable=self.dbtable, columns=columns,
+                                     rows=rows)
 
-    def markFailedCheck(self, params):
+    def updateProgresses(self, items):
         """
-        This function is used to mark an item as failed when checking it.
+        This function is used to update the progress of many dumps in a
+        single transaction.
 
-        - params (dict): Information about the item with the keys "wiki" and
-        "dumpdate".
+        - items (list): A list of dicts with the keys "wiki", "dumpdate" and
+        "progress".
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_checked': '"2"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        rows = [(item['progress'], item['wiki'], item['dumpdate'])
+                for item in items]
+        return self.sqldb.updateMany(dbtable=self.dbtable,
+                                     columns=['progress'],
+                                     keys=['wiki', 'dumpdate'], rows=rows)
 
-    def updateProgress(self, params, progress):
+    def updateCanArchives(self, items):
         """
-        This function is used to update the progress of a dump.
+        This function is used to update the can_archive status of many dumps
+        in a single transaction.
 
-        - params (dict): Information about the item with the keys "wiki" and
-        "dumpdate".
-        - progress (string): The new dump progress to update to.
+        - items (list): A list of dicts with the keys "wiki", "dumpdate" and
+        "can_archive".
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'progress': '"%s"' % (progress)
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        rows = [(item['can_archive'], item['wiki'], item['dumpdate'])
+                for item in items]
+        return self.sqldb.updateMany(dbtable=self.dbtable,
+                                     columns=['can_archive'],
+                                     keys=['wiki', 'dumpdate'], rows=rows)
 
-    def addNewItem(self, params):
+    def getStoredDumpDetails(self, wikidb):
         """
-        This function is used to insert a new item into the database.
+        This function is used to get the statuses of all dumps of a specific
+        wiki in a single query. The "update" job works on this instead of
+        querying the database for each status.
 
-        - params (dict): Information about the item with the keys "wiki",
-        "date" and "progress".
+        - wikidb (string): The database name of the wiki to get the dumps for.
 
-        Returns: True if update is successful, False if an error occurred.
+        Returns: Dict with the dump dates (in %Y%m%d format) as keys and a
+        dict with the "progress" and "can_archive" statuses as values.
         """
-        arcdate = self.conv.getDateFromWiki(params['date'],
-                                            archivedate=True)
-        values = {
-            'wiki': '"%s"' % (params['wiki']),
-            'dumpdate': '"%s"' % (arcdate),
-            'progress': '"%s"' % (params['progress']),
-            'claimed_by': 'NULL',
-            'can_archive': '"0"',
-            'is_archived': '"0"',
-            'is_checked': '"0"',
-            'comments': 'NULL'
-        }
-        return self.sqldb.insert(dbtable=self.dbtable, values=values)
+        stored = {}
+        results = self.sqldb.select(dbtable=self.dbtable,
+                                    columns=['dumpdate', 'progress',
+                                             'can_archive'],
+                                    conds='wiki=%s', params=(wikidb,))
+        if results is not None:
+            for result in results:
+                stored[result[0].strftime("%Y%m%d")] = {
+                    'progress': result[1],
+                    'can_archive': str(result[2])
+                }
+        return stored
 
-    def getStoredDumps(self, wikidb=None, progress="all", can_archive="all",
-                       is_archived="all", is_checked="all"):
+    @staticmethod
+    def filterStoredDumps(stored, progress="all", can_archive="all"):
         """
-        This function is used to get all dumps of a specific wiki (up to 30).
+        This function is used to filter the output of getStoredDumpDetails
+        (up to 30 of the latest dumps).
 
-        - wikidb (string): The database name of the wiki to get a list of
-        dumps for.
+        - stored (dict): The output of getStoredDumpDetails.
         - progress (string): Dumps with this progress will be returned, "all"
         for all progress statuses.
         - can_archive (string): Dumps with this can_archive status will be
         returned, "all" for all can_archive statuses.
-        - is_archived (string): Dumps with this is_archived status will be
-        returned, "all" for all is_archived statuses.
-        - is_checked (string): Dumps with this is_checked status will be
-        returned, "all" for all is_checked statuses.
 
-        Returns: Dict with all dumps of a wiki.
+        Returns: List of dump dates, starting from the latest dump.
         """
-        arguments = locals()
         dumps = []
-        if (wikidb is not None):
-            conds = ['wiki="%s"' % wikidb]
-        else:
-            return dumps
-
-        del arguments['self']
-        del arguments['wikidb']
-
-        for key, val in arguments.items():
-            if (val == "all"):
+        for dump in sorted(stored, reverse=True):
+            if (progress != "all" and stored[dump]['progress'] != progress):
                 continue
-            else:
-                conds.append('%s="%s"' % (key, val))
-
-        options = 'ORDER BY dumpdate DESC LIMIT 30'
-        results = self.sqldb.select(dbtable=self.dbtable,
-                                    columns=['dumpdate'],
-                                    conds=' AND '.join(conds), options=options)
-        if results is not None:
-            for result in results:
-                dumps.append(result[0].strftime("%Y%m%d"))
-        return dumps
+            elif (can_archive != "all" and
+                  stored[dump]['can_archive'] != str(can_archive)):
+                continue
+            dumps.append(dump)
+        return dumps[:30]
 
-    def updateNewDumps(self, db):
+    def updateNewDumps(self, db, alldumps, stored):
         """
         This function is used to check if all new dumps have been registered
         and update the database accordingly for new dumps. This function is
         called during the "update" job.
 
         - db (string): The database to work on.
-        """
-        alldumps = self.getAllDumps(db)
-        stored = self.getStoredDumps(db)
-        for dump in alldumps:
-            if (dump in stored):
-                self.common.giveMessage("Dump of %s on %s already in the "
-                                        "database, skipping" % (db, dump))
-                continue
-            else:
-                self.common.giveMessage("Adding new item %s on "
-                                        "%s" % (db, dump))
-                progress = self.getDumpProgress(db, dump)
-                params = {
-                    'wiki': db,
-                    'date': dump,
-                    'progress': progress
-                }
-                self.addNewItem(params=params)
+        - alldumps (list): A list of all dumps on the dumps server.
+        - stored (dict): The output of getStoredDumpDetails, which will be
+        updated with the new dumps.
+
+        Returns: List of new items to be added with addNewItems.
+        """
+        newitems = []
+        newdumps = sorted(set(alldumps) - set(stored))
+        self.common.giveMessage("%d of %d dumps of %s are already in the "
+                                "database" % (len(alldumps) - len(newdumps),
+                                              len(alldumps), db))
+        for dump in newdumps:
+            self.common.giveMessage("Adding new item %s on %s" % (db, dump))
+            progress = self.getDumpProgress(db, dump)
+            newitems.append({
+                'wiki': db,
+                'date': dump,
+                'progress': progress
+            })
+            stored[dump] = {
+                'progress': progress,
+                'can_archive': '0'
+            }
+        return newitems
 
-    def updateDumpStatuses(self, db):
+    def updateDumpStatuses(self, db, stored):
         """
         This function is used for checking the dumps that are registered as
         "in progress" and update the status if those dumps have changed their
         progress status. This function is called during the "update" job.
 
         - db (string): The database to work on.
+        - stored (dict): The output of getStoredDumpDetails.
+
+        Returns: List of progress updates to be made with updateProgresses.
         """
-        inprogress = self.getStoredDumps(db, progress="progress")
+        updates = []
+        inprogress = self.filterStoredDumps(stored, progress="progress")
         for dump in inprogress:
             progress = self.getDumpProgress(db, dump)
             if (progress != 'progress'):
                 self.common.giveMessage("Updating dump progress for %s "
                                         "on %s" % (db, dump))
-                params = {
+                updates.append({
                     'wiki': db,
                     'dumpdate': self.conv.getDateFromWiki(dump,
-                                                          archivedate=True)
-                }
-                self.updateProgress(params=params, progress=progress)
+                                                          archivedate=True),
+                    'progress': progress
+                })
+                stored[dump]['progress'] = progress
             else:
                 continue
+        return updates
 
-    def updateCanArchiveStatus(self, db):
+    def updateCanArchiveStatus(self, db, stored):
         """
         This function is used for checking existing dumps that have been
         completed and updates the database if these dumps are ready to be
         archived. This function is called during the "update" job.
 
         - db (string): The database to work on.
+        - stored (dict): The output of getStoredDumpDetails.
+
+        Returns: List of can_archive updates to be made with
+        updateCanArchives.
         """
-        cannotarc = self.getStoredDumps(db, progress="done", can_archive=0)
+        updates = []
+        cannotarc = self.filterStoredDumps(stored, progress="done",
+                                           can_archive=0)
         for dump in cannotarc:
             if not self.checkDumpExists(db, dump):
                 continue
@@ -714,24 +855,30 @@ class BALMDumps(object):
                 # The dump is now suitable to be archived
                 self.common.giveMessage("Updating can_archive for %s "
                                         "on %s" % (db, dump))
-                params = {
+                updates.append({
                     'wiki': db,
                     'dumpdate': self.conv.getDateFromWiki(dump,
-                                                          archivedate=True)
-                }
-                self.updateCanArchive(params=params, can_archive=1)
+                                                          archivedate=True),
+                    'can_archive': 1
+                })
+                stored[dump]['can_archive'] = '1'
 #            else:
 #                continue
+        return updates
 
-    def updateFailedDumps(self, db):
+    def updateFailedDumps(self, db, stored):
         """
         This function is used for checking whether the dumps that have been
         marked as failed really did fail or have been restarted. This function
         is called during the "update" job.
 
         - db (string): The database to work on.
+        - stored (dict): The output of getStoredDumpDetails.
+
+        Returns: List of progress updates to be made with updateProgresses.
         """
-        failed = self.getStoredDumps(db, progress="error")
+        updates = []
+        failed = self.filterStoredDumps(stored, progress="error")
         for dump in failed:
             if not self.checkDumpExists(db, dump):
                 continue
@@ -740,24 +887,31 @@ class BALMDumps(object):
             if (progress != 'error' and progress != 'unknown'):
                 self.common.giveMessage("Updating dump progress for %s "
                                         "on %s" % (db, dump))
-                params = {
+                updates.append({
                     'wiki': db,
                     'dumpdate': self.conv.getDateFromWiki(dump,
-                                                          archivedate=True)
-                }
-                self.updateProgress(params=params, progress=progress)
+                                                          archivedate=True),
+                    'progress': progress
+                })
+                stored[dump]['progress'] = progress
             else:
                 continue
+        return updates
 
-    def updateOldCanArchiveStatus(self, db):
+    def updateOldCanArchiveStatus(self, db, stored):
         """
         This function is used for checking whether the dumps marked as "can
         archive" is really able to be archived or has been deleted. This
         function is called during the "update" job.
 
         - db (string): The database to work on.
+        - stored (dict): The output of getStoredDumpDetails.
+
+        Returns: List of can_archive updates to be made with
+        updateCanArchives.
         """
-        canarc = self.getStoredDumps(db, can_archive=1)
+        updates = []
+        canarc = self.filterStoredDumps(stored, can_archive=1)
         for dump in canarc:
 #            dumpdir = "%s/%s/%s" % (self.config.get('dumpdir'), db, dump)
 #            allfiles = self.getDumpFiles(db, dump)
@@ -768,14 +922,16 @@ class BALMDumps(object):
                 # The dump is now unable to be archived automatically
                 self.common.giveMessage("Updating can_archive for %s on "
                                         "%s" % (db, dump))
-                params = {
+                updates.append({
                     'wiki': db,
                     'dumpdate': self.conv.getDateFromWiki(dump,
-                                                          archivedate=True)
-                }
-                self.updateCanArchive(params=params, can_archive=0)
+                                                          archivedate=True),
+                    'can_archive': 0
+                })
+                stored[dump]['can_archive'] = '0'
+        return updates
 
-    def getFilesToUpload(self, wiki, dumpdate, path=None):
+    def getFilesToUpload(self, wiki, dumpdate, path=None, allfiles=None):
         """
         This function is used to generate the list of files to upload given
         the circumstances.
@@ -783,27 +939,26 @@ class BALMDumps(object):
         - wiki (string): The wiki database to work on.
         - dumpdate (string): The date of the dump in %Y%m%d format.
         - path (string): The path to the dump directory.
+        - allfiles (list): The output of getDumpFiles, if it has already been
+        obtained.
 
         Returns: List of files to upload.
         """
         iaitem = balchivist.BALArchiver('%s-%s' % (wiki, dumpdate),
                                         verbose=self.verbose, debug=self.debug)
-        allfiles = self.getDumpFiles(wiki, dumpdate)
+        if (allfiles is None):
+            allfiles = self.getDumpFiles(wiki, dumpdate)
         # Check which files are missing in order to resume upload
         if self.resume:
-            items = []
-            iafiles = iaitem.getFileList()
-            for dumpfile in allfiles:
-                if dumpfile in iafiles:
-                    continue
-                else:
-                    # The file does not exist in the Internet Archive item
-                    items.append(dumpfile)
+            iafiles = iaitem.getFileSet()
+            # Only upload the files that do not exist in the item
+            items = [dumpfile for dumpfile in allfiles
+                     if dumpfile not in iafiles]
             if items == []:
                 self.common.giveMessage("All files have already been uploaded")
                 return items
         else:
-            items = allfiles
+            items = list(allfiles)
 
         # Check if checksums are available and add them if they do
         for checksum in self.checksums:
@@ -815,6 +970,36 @@ class BALMDumps(object):
                 continue
         return items
 
+    def startDumpFileDownload(self, wiki, date, dumps, filename,
+                              rsync=True):
+        """
+        This function is used to start downloading a single file of a dump
+        into the dump directory, without waiting for the download to finish.
+
+        - wiki (string): The wiki database of the dump.
+        - date (string): The date of the dump in %Y%m%d format.
+        - dumps (string): The path to the dump directory.
+        - filename (string): The name of the file to download.
+        - rsync (boolean): Whether or not to download the file using rsync.
+
+        Returns: subprocess.Popen object of the download, which can be waited
+        on or killed.
+        """
+        try:
+            os.makedirs(dumps)
+        except OSError:
+            # The directory already exists
+            pass
+        if rsync:
+            command = ['rsync', '-avzP',
+                       'rsync://ftpmirror.your.org/wikimedia-dumps/%s/%s/%s' %
+                       (wiki, date, filename), '.']
+        else:
+            command = ['wget', '-q', '--show-progress',
+                       'http://dumps.wikimedia.your.org/%s/%s/%s' %
+                       (wiki, date, filename)]
+        return subprocess.Popen(command, cwd=dumps)
+
     def archive(self, wiki, date, path=None):
         """
         This function is for doing the actual archiving process.
@@ -825,15 +1010,20 @@ class BALMDumps(object):
 
         Returns: True if process is successful, False if otherwise.
         """
-        largewikis = ['enwiki', 'wikidatawiki', 'dewiki', 'commonswiki']
-        md = self.getItemMetadata(wiki=wiki, dumpdate=date)
-        headers = {
-            'x-archive-size-hint': self.sizehint
-        }
         allfiles = self.getDumpFiles(wiki, date)
+        if (allfiles == []):
+            # The dump is incomplete or its status report is missing
+            self.common.giveMessage("No dump files are available for %s on "
+                                    "%s" % (wiki, date))
+            return False
+        md = self.getItemMetadata(wiki=wiki, dumpdate=date)
         iaitem = balchivist.BALArchiver('%s-%s' % (wiki, date),
                                         verbose=self.verbose, debug=self.debug)
-        items = self.getFilesToUpload(wiki=wiki, dumpdate=date, path=path)
+        items = self.getFilesToUpload(wiki=wiki, dumpdate=date, path=path,
+                                      allfiles=allfiles)
+        if (items == []):
+            # Nothing needs to be downloaded or uploaded
+            return True
         dumps = "%s/%s/%s" % (self.config.get('dumpdir'), wiki, date)
 
         # Test availability of rsync first
@@ -843,24 +1033,48 @@ class BALMDumps(object):
             # Rsync not available
             useRsync = False
 
-        if wiki in largewikis:
-            for thefile in items:
-                templist = [thefile]
-                if useRsync:
-                    os.system("mkdir -p %s && cd %s && rsync -avzP rsync://ftpmirror.your.org/wikimedia-dumps/%s/%s/%s ." % (dumps, dumps, wiki, date, thefile))
-                else:
-                    os.system("mkdir -p %s && cd %s && wget -q --show-progress http://dumps.wikimedia.your.org/%s/%s/%s" % (dumps, dumps, wiki, date, thefile))
-
-                if (self.common.checkDumpDir(path=dumps, filelist=templist)):
-                    pass
-                else:
-                    # The dump directory is not suitable to be used, exit the function
-                    return False
-
-                os.chdir(dumps)
-                upload = iaitem.upload(body=templist, metadata=md, headers=headers)
-                if upload:
-                    shutil.rmtree(dumps)
+        status = True
+        if wiki in self.largewikis:
+            # Download the next file while the current one is being uploaded
+            pending = self.startDumpFileDownload(wiki, date, dumps, items[0],
+                                                 rsync=useRsync)
+            try:
+                for index, thefile in enumerate(items):
+                    templist = [thefile]
+                    pending.wait()
+                    pending = None
+                    if not (self.common.checkDumpDir(path=dumps,
+                                                     filelist=templist)):
+                        # The dump directory is not suitable to be used
+                        status = False
+                        break
+
+                    if (index + 1 < len(items)):
+                        pending = self.startDumpFileDownload(
+                            wiki, date, dumps, items[index + 1],
+                            rsync=useRsync
+                        )
+
+                    if (index == 0):
+                        # Only the first file needs to create the item
+                        upload = iaitem.upload(body=templist, metadata=md,
+                                               headers=self.headers,
+                                               path=dumps)
+                    else:
+                        upload = iaitem.upload(body=templist, path=dumps)
+                    if upload:
+                        # The next file may already be in the directory
+                        os.remove(os.path.join(dumps, thefile))
+                    else:
+                        # Do not mark a partially uploaded dump as archived
+                        status = False
+                        break
+            finally:
+                if (pending is not None and pending.poll() is None):
+                    # The file will not be uploaded, so do not wait for the
+                    # rest of it to be downloaded
+                    pending.kill()
+                    pending.wait()
         else:
             if useRsync:
                 os.system("mkdir -p %s && cd %s && rsync -avzP rsync://ftpmirror.your.org/wikimedia-dumps/%s/%s/ ." % (dumps, dumps, wiki, date))
@@ -871,18 +1085,15 @@ class BALMDumps(object):
                     time.sleep(0.1) # For Ctrl+C
 
             if (self.common.checkDumpDir(path=dumps, filelist=items)):
-                pass
+                status = iaitem.upload(body=items, metadata=md,
+                                       headers=self.headers, path=dumps)
             else:
-                # The dump directory is not suitable to be used, exit the function
-                return False
+                # The dump directory is not suitable to be used
+                status = False
 
-            os.chdir(dumps)
-            upload = iaitem.upload(body=items, metadata=md, headers=headers)
-            if upload:
-                shutil.rmtree(dumps)
-
-        os.chdir(self.config.get('dumpdir'))
-        os.system("rm -rf %s/%s" % (self.config.get('dumpdir'), wiki))
+        # Only remove the directory of this dump as other dumps of the same
+        # wiki may be worked on at the same time
+        shutil.rmtree(dumps, ignore_errors=True)
 
         #if (path is None):
         #    dumps = "%s/%s/%s" % (self.config.get('dumpdir'), wiki, date)
@@ -894,7 +1105,7 @@ class BALMDumps(object):
         #else:
             # The dump directory is not suitable to be used, exit the function
         #    return False
-        return True
+        return status
 
     def check(self, wiki, date):
         """
@@ -905,89 +1116,177 @@ class BALMDumps(object):
 
         Returns: True if complete, False if errors have occurred.
         """
-        complete = True
         allfiles = self.getDumpFiles(wiki, date)
         iaitem = balchivist.BALArchiver('%s-%s' % (wiki, date),
                                         debug=self.debug, verbose=self.verbose)
-        iafiles = iaitem.getFileList()
+        iafiles = iaitem.getFileSet()
         self.common.giveMessage("Checking if all files are uploaded for %s "
                                 "on %s" % (wiki, date))
-        for dumpfile in allfiles:
-            if (dumpfile in iafiles):
-                continue
-            else:
-                # The Internet Archive have got incomplete items
-                complete = False
-        return complete
+        # The item is incomplete if any of the dump files is missing
+        return set(allfiles).issubset(iafiles)
+
+    def updateDatabase(self, db):
+        """
+        This function runs all the steps of the "update" job for a single
+        wiki. It is safe to run for many wikis at the same time as each thread
+        uses its own connection to the database server.
+
+        - db (string): The database to work on.
+        """
+        alldumps = self.getAllDumps(db)
+        stored = self.getStoredDumpDetails(db)
+        # Step 1: Check if all new dumps are registered
+        newitems = self.updateNewDumps(db, alldumps=alldumps, stored=stored)
+        # Step 2: Check if the status of dumps in progress have changed
+        progresses = self.updateDumpStatuses(db, stored=stored)
+        # Step 3: Check if the dump is available for archiving
+        canarchives = self.updateCanArchiveStatus(db, stored=stored)
+        # Step 4: Check if failed dumps really did fail or was restarted
+        progresses += self.updateFailedDumps(db, stored=stored)
+        # Step 5: Reset the can_archive statuses of old dumps
+        canarchives += self.updateOldCanArchiveStatus(db, stored=stored)
+        # Write all changes for the wiki in one transaction per step
+        written = [
+            self.addNewItems(newitems),
+            self.updateProgresses(progresses),
+            self.updateCanArchives(canarchives)
+        ]
+        if (self.debug or not all(written)):
+            # The wiki needs to be updated again by a resumed update
+            return
+        # Remember that the wiki is done in case the update is interrupted.
+        # Each line is written in a single call, so threads can share it.
+        with open(self.updateprogress, 'a') as progressfile:
+            progressfile.write("%s\n" % (db))
+
+    def getUpdatedDatabases(self):
+        """
+        This function is used to get the wikis that have already been done by
+        an earlier update that was interrupted within the last day.
+
+        Returns: Set of databases that do not need to be updated again.
+        """
+        try:
+            lastchange = os.stat(self.updateprogress).st_mtime
+        except OSError:
+            return set()
+        if (lastchange < time.time() - 60*60*24*1):
+            # The interrupted update is too old to be continued
+            return set()
+        with open(self.updateprogress, 'r') as progressfile:
+            return set([line.strip() for line in progressfile])
 
     def update(self):
         """
         This function checks for new dumps and add new entries into the
         database.
 
+        Note: If an update is interrupted, the next update within a day will
+        only work on the wikis that were not done.
+
         Returns: True if complete, Exception if an error occurred.
         """
-        alldb = self.getDatabases('all.dblist')
-        privatedb = self.getDatabases('private.dblist')
-        # Remove all instances of private wikis
-        for private in privatedb:
-            alldb.remove(private)
-        for db in alldb:
-            # Step 1: Check if all new dumps are registered
-            self.updateNewDumps(db)
-            # Step 2: Check if the status of dumps in progress have changed
-            self.updateDumpStatuses(db)
-            # Step 3: Check if the dump is available for archiving
-            self.updateCanArchiveStatus(db)
-            # Step 4: Check if failed dumps really did fail or was restarted
-            self.updateFailedDumps(db)
-            # Step 5: Reset the can_archive statuses of old dumps
-            self.updateOldCanArchiveStatus(db)
-
+        # Remove all instances of private wikis and those already done
+        alldb = sorted(set(self.getDatabases('all.dblist')) -
+                       set(self.getDatabases('private.dblist')) -
+                       self.getUpdatedDatabases())
+        # The wikis are independent of each other, so work on them at once
+        self.common.parallelMap(self.updateDatabase, alldb,
+                                workers=self.workers)
+
+        # The next update should start from the beginning again
+        if (os.path.exists(self.updateprogress)):
+            os.remove(self.updateprogress)
         return True
 
-    def dispatch(self, job, wiki, date, path):
+    def dispatch(self, job, wiki, date, path, claimed=False):
         """
         This function is for dispatching an item to the various functions.
+
+        - claimed (boolean): Whether or not the item has already been claimed
+        by this instance.
         """
+        if (job not in self.jobmarks):
+            return False
+
         updatedetails = {
             'wiki': wiki,
             'dumpdate': self.conv.getDateFromWiki(date, archivedate=True)
         }
 
         # Claim the item from the database server if not in debug mode
-        if self.debug:
-            pass
-        else:
+        if not (self.debug or claimed):
             self.sqldb.claimItem(params=updatedetails, dbtable=self.dbtable)
 
-        msg = "Running %s on the main Wikimedia database " % (job)
-        msg += "dump of %s on %s" % (wiki, date)
-        self.common.giveMessage(msg)
         if (job == "archive"):
             status = self.archive(wiki=wiki, date=date, path=path)
-            if (self.debug):
-                return status
-            elif (self.debug is False and status):
-                self.common.giveMessage("Marking %s on %s as archived" %
-                                        (wiki, date))
-                self.markArchived(updatedetails)
-            else:
-                self.common.giveMessage("Marking %s on %s as failed"
-                                        " archive" % (wiki, date))
-                self.markFailedArchive(updatedetails)
-        elif (job == "check"):
-            status = self.check(wiki=wiki, date=date)
-            if (self.debug):
-                return status
-            elif (self.debug is False and status):
-                self.common.giveMessage("Marking %s on %s as checked" %
-                                        (wiki, date))
-                self.markChecked(updatedetails)
-            else:
-                self.common.giveMessage("Marking %s on %s as failed"
-                                        " check" % (wiki, date))
-                self.markFailedCheck(updatedetails)
+        else:
+            status = getattr(self, job)(wiki=wiki, date=date)
+        success, failure = self.jobmarks[job]
+        mark = success if status else failure
+
+        # Give a single message for each item after it has been worked on
+        self.common.giveMessage("Ran %s on the main Wikimedia database dump "
+                                "of %s on %s: %s" % (job, wiki, date, mark))
+        if (self.debug):
+            return status
+        self.queueMark(mark, updatedetails)
+
+    def dispatchParallel(self, job, path, workers, idle=0, queue=None):
+        """
+        This function is used to work on all pending items of a job using a
+        pool of processes, with each process working on a different item.
+
+        - job (string): The job to execute.
+        - path (string): The path to the wiki dump directory.
+        - workers (int): The number of processes to use.
+        - idle (int): The number of seconds to keep waiting for new items after
+        running out of them.
+        - queue (string): The queue to get the items from (see getJobConds).
+        """
+        params = {
+            'verbose': self.verbose,
+            'debug': self.debug
+        }
+        limit = self.getBatchLimit(job=job, workers=workers)
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            # Get the items in batches instead of one query per item
+            for batch in self.getPendingBatches(job=job, limit=limit,
+                                                idle=idle, queue=queue):
+                tasks = [(params, job, item['wiki'], item['date'], path)
+                         for item in batch]
+                # Waiting with a timeout allows KeyboardInterrupt to be raised
+                pool.map_async(dispatchItem, tasks,
+                               chunksize=1).get(60*60*24*365)
+        except:
+            pool.terminate()
+            raise
+        finally:
+            # The worker processes write the marks of the items they worked
+            # on, so anything still claimed by this process was not done
+            self.releaseClaims()
+        pool.close()
+        pool.join()
+
+    def getRunMode(self, args=None):
+        """
+        This function is used to decide how to run the module from the
+        arguments given.
+
+        - args (namespace): A namespace of all the arguments from argparse.
+
+        Returns: Tuple with the mode ("continuous", "single", "update" or
+        "error") and the error message to give if the arguments are invalid.
+        """
+        if (args is None):
+            # It is likely that --auto has been declared when args is None
+            return ('continuous', None)
+        elif (args.dumpsjob == "update"):
+            return ('update', None)
+        else:
+            return self.runmodes[(args.dumpswiki is not None,
+                                  args.dumpsdate is not None)]
 
     def execute(self, args=None):
         """
@@ -999,46 +1298,88 @@ class BALMDumps(object):
         Returns True if all required processing is successful, False if an
         error has occurred.
         """
-        continuous = False
-        if (args is None):
-            # It is likely that --auto has been declared when args is None
-            continuous = True
-        elif (args.dumpsjob == "update"):
+        mode, error = self.getRunMode(args=args)
+        if (mode == "update"):
             return self.update()
-        elif (args.dumpswiki is None and args.dumpsdate is None):
-            continuous = True
-        elif (args.dumpswiki is None and args.dumpsdate is not None):
-            self.common.giveError("Error: Date was given but not the wiki!")
-            return False
-        elif (args.dumpswiki is not None and args.dumpsdate is None):
-            self.common.giveError("Error: Wiki was given but not the date!")
+        elif (mode == "error"):
+            self.common.giveError(error)
             return False
-        else:
-            pass
-
-        if (continuous):
+        elif (mode == "continuous"):
             if (args is None):
                 # Default to performing the archive job
                 dumpsjob = "archive"
                 dumpspath = None
+                workers = 1
+                idle = 0
+                queue = None
             else:
                 dumpsjob = args.dumpsjob
                 dumpspath = args.dumpspath
+                workers = args.dumpsworkers
+                idle = args.dumpsidle
+                queue = args.dumpsqueue
 
-            while self.getItemsLeft(job=dumpsjob) > 0:
-                itemdetails = self.getRandomItem(job=dumpsjob)
-                wiki = itemdetails['wiki']
-                date = itemdetails['date']
-                self.dispatch(job=dumpsjob, wiki=wiki, date=date,
-                              path=dumpspath)
+            if (self.debug):
+                # Nothing is claimed or marked in debug mode, so the same
+                # items would keep coming back. Go through a sample once.
+                for item in self.getPendingItems(job=dumpsjob, limit=50,
+                                                 queue=queue):
+                    self.dispatch(job=dumpsjob, wiki=item['wiki'],
+                                  date=item['date'], path=dumpspath)
+                return True
+            elif (workers > 1):
+                self.dispatchParallel(job=dumpsjob, path=dumpspath,
+                                      workers=workers, idle=idle,
+                                      queue=queue)
+                return True
+
+            # Look up the methods once instead of for every item
+            dispatch = self.dispatch
+            flushmarks = self.flushMarks
+            limit = self.getBatchLimit(job=dumpsjob)
+            try:
+                # Get the items in batches instead of one query per item
+                for batch in self.getPendingBatches(job=dumpsjob, limit=limit,
+                                                    idle=idle, queue=queue):
+                    for item in batch:
+                        dispatch(job=dumpsjob, wiki=item['wiki'],
+                                 date=item['date'], path=dumpspath,
+                                 claimed=True)
+                        flushmarks(force=False)
+            finally:
+                # Do not leave any items claimed when exiting, including the
+                # rest of the batch if the job was interrupted
+                self.flushMarks()
+                self.releaseClaims()
+                self.sqldb.close()
         else:
             self.resume = args.dumpsresume
             self.dispatch(job=args.dumpsjob, wiki=args.dumpswiki,
                           date=args.dumpsdate, path=args.dumpspath)
+            self.flushMarks()
 
         return True
 
 
+def dispatchItem(task):
+    """
+    This function is used by BALMDumps.dispatchParallel to work on an item in
+    a worker process. It needs to be at the module level so that it can be
+    sent to the worker processes.
+
+    - task (tuple): The params, job, wiki, date and path of the item.
+    """
+    params, job, wiki, date, path = task
+    sqldb = balchivist.BALSqlDb.getFromConf()
+    dumps = BALMDumps(params=params, sqldb=sqldb)
+    try:
+        return dumps.dispatch(job=job, wiki=wiki, date=date, path=path,
+                              claimed=True)
+    finally:
+        dumps.flushMarks()
+        sqldb.close()
+
+
 if __name__ == "__main__":
     BALMessage = balchivist.BALMessage()
     IncorrectUsage = balchivist.exception.IncorrectUsage
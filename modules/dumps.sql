@@ -14,3 +14,4 @@ CREATE TABLE dumps (
 CREATE INDEX progress ON dumps (progress);
 CREATE INDEX is_archived ON dumps (is_archived);
 CREATE INDEX is_checked ON dumps (is_checked);
+CREATE INDEX pending ON dumps (claimed_by, is_archived, is_checked, progress, can_archive);
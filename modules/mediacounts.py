@@ -218,7 +218,7 @@ class BALMMediacounts(object):
         Returns: Int with number of items left to work with.
         """
         conds = ['claimed_by IS NULL']
-        for key, val in params.iteritems():
+        for key, val in params.items():
             conds.append('%s="%s"' % (key, val))
         return self.sqldb.count(dbtable=self.dbtable,
                                 conds=' AND '.join(conds))
@@ -413,8 +413,8 @@ class BALMMediacounts(object):
             # The dump directory is not suitable to be used, exit the function
             return False
 
-        os.chdir(dumps)
-        upload = iaitem.upload(body=allfiles, metadata=md, headers=headers)
+        upload = iaitem.upload(body=allfiles, metadata=md, headers=headers,
+                               path=dumps)
 
         if (upload and path is None):
             self.removeFiles(allfiles)
@@ -435,7 +435,7 @@ class BALMMediacounts(object):
         identifier = "mediacounts-%s" % (dumpdate)
         iaitem = balchivist.BALArchiver(identifier=identifier,
                                         verbose=self.verbose, debug=self.debug)
-        iafiles = iaitem.getFileList()
+        iafiles = iaitem.getFileSet()
         self.common.giveMessage("Checking if all files are uploaded for the "
                                 "%s dump" % (dumpdate))
         for dumpfile in allfiles:
@@ -462,7 +462,7 @@ class BALMMediacounts(object):
         daybefore = twoday.strftime("%Y%m%d")
         threedays = theday.strftime("%Y%m%d")
 
-        alldumps = self.getDumpDates()
+        alldumps = set(self.getDumpDates())
 
         # Add yesterday's date into the database
         if (yesterday in alldumps):
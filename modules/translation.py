@@ -144,7 +144,7 @@ class BALMTranslation(object):
         allfiles = self.getFiles(dumpdate)
         if self.resume:
             items = []
-            iafiles = iaitem.getFileList()
+            iafiles = iaitem.getFileSet()
             for dumpfile in allfiles:
                 if dumpfile in iafiles:
                     continue
@@ -225,7 +225,7 @@ class BALMTranslation(object):
         Returns: Int with number of items left to work with.
         """
         conds = ['claimed_by IS NULL']
-        for key, val in params.iteritems():
+        for key, val in params.items():
             conds.append('%s="%s"' % (key, val))
         return self.sqldb.count(dbtable=self.dbtable,
                                 conds=' AND '.join(conds))
@@ -395,7 +395,7 @@ class BALMTranslation(object):
 
         - alldumps (list): A list of all dumps.
         """
-        storeddumps = self.getDumpDates()
+        storeddumps = set(self.getDumpDates())
         for dump in alldumps:
             if (dump in storeddumps):
                 self.common.giveMessage("Dump on %s already in the database, "
@@ -416,8 +416,10 @@ class BALMTranslation(object):
         cannotarc = self.getDumpDates(can_archive=0)
         lastweek = datetime.datetime.now()
         lastweek -= datetime.timedelta(days=7)
+        cutoff = lastweek.strftime("%Y%m%d")
+        available = set(alldumps)
         for dump in cannotarc:
-            if (dump <= lastweek.strftime("%Y%m%d") and dump in alldumps):
+            if (dump <= cutoff and dump in available):
                 # The dump is now suitable to be archived
                 self.common.giveMessage("Updating can_archive for the dump "
                                         "on %s" % (dump))
@@ -434,8 +436,9 @@ class BALMTranslation(object):
         - alldumps (list): A list of all dumps.
         """
         canarc = self.getDumpDates(can_archive=1)
+        available = set(alldumps)
         for dump in canarc:
-            if (dump in alldumps):
+            if (dump in available):
                 continue
             else:
                 # The dump is now unable to be archived
@@ -475,8 +478,8 @@ class BALMTranslation(object):
             # The dump directory is not suitable to be used, exit the function
             return False
 
-        os.chdir(dumps)
-        upload = iaitem.upload(body=allfiles, metadata=md, headers=headers)
+        upload = iaitem.upload(body=allfiles, metadata=md, headers=headers,
+                               path=dumps)
 
         if (upload and path is None):
             shutil.rmtree(dumps)
@@ -497,7 +500,7 @@ class BALMTranslation(object):
         identifier = "contenttranslation-%s" % (dumpdate)
         iaitem = balchivist.BALArchiver(identifier=identifier,
                                         verbose=self.verbose, debug=self.debug)
-        iafiles = iaitem.getFileList()
+        iafiles = iaitem.getFileSet()
         self.common.giveMessage("Checking if all files are uploaded for the "
                                 "%s dump" % (dumpdate))
         for dumpfile in allfiles:
@@ -15,8 +15,16 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+from multiprocessing.pool import ThreadPool
 import os
+try:
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
 import shutil
+import threading
+import time
 
 import balchivist
 
@@ -46,6 +54,28 @@ class BALMWikidata(object):
     ]
     # A size hint for the Internet Archive, currently set at 100GB
     sizehint = "107374182400"
+    # The number of pages to fetch from the dumps server at the same time
+    workers = 16
+    # The column and value to update for each mark given to an item
+    marks = {
+        'archived': ('is_archived', 1),
+        'failedarchive': ('is_archived', 2),
+        'checked': ('is_checked', 1),
+        'failedcheck': ('is_checked', 2)
+    }
+    # The marks to give an item after each job if it succeeded or failed
+    jobmarks = {
+        'archive': ('archived', 'failedarchive'),
+        'check': ('checked', 'failedcheck')
+    }
+    # The number of marks to buffer before writing them to the database
+    markbatch = 50
+    # The dump date column formatted as %Y%m%d by the database server. The %
+    # signs are doubled as the queries are formatted with their parameters.
+    dumpdatecolumn = "DATE_FORMAT(dumpdate, '%%Y%%m%%d')"
+    # Dump files of each dump, keyed by (database, dumpdate). This is shared
+    # between instances since dumps are only archived once they are complete.
+    dumpfiles = {}
 
     def __init__(self, params={}, sqldb=None):
         """
@@ -62,6 +92,9 @@ class BALMWikidata(object):
         self.debug = params['debug']
         self.common = balchivist.BALCommon(verbose=self.verbose,
                                            debug=self.debug)
+        # Marks waiting to be written to the database, see queueMark
+        self.pendingmarks = {}
+        self.marksflushed = time.time()
 
     @classmethod
     def argparse(cls, parser=None):
@@ -122,41 +155,23 @@ class BALMWikidata(object):
     def getFiles(self, database, dumpdate):
         """
         This function is for getting a list of dump files available to be
-        archived for the given wiki.
+        archived for the given wiki. The list is cached so that archiving and
+        checking the same dump only fetches it once.
 
         - database (string): The database to get the dump files for.
+        - dumpdate (string): The date of the dump in %Y%m%d format.
 
         Returns list of all files.
         """
-        url = "%s/%s/%s/" % (self.config.get('baseurl'), database, dumpdate)
-        return self.common.extractLinks(url)
-
-    def getStoredDumps(self, database, can_archive="all"):
-        """
-        This function is for getting a list of dumps that are currently stored
-        in the database.
+        if (database, dumpdate) in self.dumpfiles:
+            # Return a copy as callers may change the list
+            return list(self.dumpfiles[(database, dumpdate)])
 
-        - database (string): The database to get a list of dumps for.
-        - can_archive (string): Dumps with this can_archive status will be
-        returned, "all" for all can_archive statuses.
-
-        Returns list of all dump dates.
-        """
-        dumps = []
-        conds = ['wiki="%s"' % database]
-        if (can_archive == "all"):
-            pass
-        else:
-            conds.append('can_archive="%s"' % (can_archive))
-
-        options = 'ORDER BY dumpdate DESC LIMIT 30'
-        results = self.sqldb.select(dbtable=self.dbtable,
-                                    columns=['dumpdate'],
-                                    conds=' AND '.join(conds), options=options)
-        if results is not None:
-            for result in results:
-                dumps.append(result[0].strftime("%Y%m%d"))
-        return dumps
+        url = "%s/%s/%s/" % (self.config.get('baseurl'), database, dumpdate)
+        files = self.common.extractLinks(url)
+        if (files != []):
+            self.dumpfiles[(database, dumpdate)] = files
+        return list(files)
 
     def getItemMetadata(self, database, dumpdate):
         """
@@ -191,294 +206,289 @@ class BALMWikidata(object):
         }
         return metadata
 
-    def getItemsLeft(self, job=None):
-        """
-        This function is used for getting the number of items left to be done
-        for a specific job.
-
-        Note: The "update" job should not be using this!
-
-        - job (string): The job to obtain the count for.
-
-        Returns: Int with the number of items left to work on.
-        """
-        conds = {}
-        if (job is None or job == "archive"):
-            conds['is_archived'] = "0"
-            conds['can_archive'] = "1"
-            return self.getNumberOfItems(params=conds)
-        elif (job == "check"):
-            conds['is_archived'] = "1"
-            conds['is_checked'] = "0"
-            return self.getNumberOfItems(params=conds)
-        else:
-            return 0
-
-    def getNumberOfItems(self, params={}):
+    def getJobConds(self, job=None):
         """
-        This function is used to get the number of items left to work with.
+        This function is used to get the conditions for the items that are
+        waiting to be worked on for a specific job.
 
-        - params (dict): The conditions to put in the WHERE clause.
+        - job (string): The job to get the conditions for.
 
-        Returns: Int with number of items left to work with.
+        Returns: List of SQL-like conditions, None if the job is not known.
         """
         conds = ['claimed_by IS NULL']
-        for key, val in params.iteritems():
-            conds.append('%s="%s"' % (key, val))
-        return self.sqldb.count(dbtable=self.dbtable,
-                                conds=' AND '.join(conds))
-
-    def getRandomItem(self, job=None):
-        """
-        This function is used for getting a random item to work on for a
-        specific job.
-
-        Returns: Dict with the information about the item to work on.
-        """
         if (job is None or job == "archive"):
-            itemdetails = self.getRandomItemSql(archived=False)
-            output = {
-                'wiki': itemdetails['wiki'],
-                'date': itemdetails['date']
-            }
+            conds.extend([
+                'is_archived="0"',
+                'can_archive="1"'
+            ])
         elif (job == "check"):
-            itemdetails = self.getRandomItemSql(archived=True)
-            output = {
-                'wiki': itemdetails['wiki'],
-                'date': itemdetails['date']
-            }
-        elif (job == "update"):
-            output = {
-                'wiki': None,
-                'date': None
-            }
-        else:
-            output = {}
-        return output
-
-    def getRandomItemSql(self, archived=False):
-        """
-        This function is used to get a random item to work on.
-
-        - archived (boolean): Whether or not to obtain a random item that is
-        already archived.
-
-        Returns: Dict with the parameters to the archiving scripts.
-        """
-        output = {}
-        columns = ['wiki', 'dumpdate']
-        options = 'ORDER BY RAND() LIMIT 1'
-        conds = ['claimed_by IS NULL']
-
-        if (archived):
-            extra = [
+            conds.extend([
                 'is_archived="1"',
                 'is_checked="0"'
-            ]
+            ])
         else:
-            extra = [
-                'is_archived="0"',
-                'can_archive="1"'
-            ]
-        conds.extend(extra)
-
-        results = self.sqldb.select(dbtable=self.dbtable, columns=columns,
-                                    conds=' AND '.join(conds), options=options)
-        if results is None:
-            # This should not be triggered at all. Use self.getItemsLeft()
-            # to verify first before running this function.
-            output = {
-                'wiki': None,
-                'date': None
-            }
+            return None
+        return conds
+
+    def getPendingItems(self, job=None, limit=16, claim=False):
+        """
+        This function is used to get a batch of items to work on for a
+        specific job in a single round trip.
+
+        - job (string): The job to get the items for.
+        - limit (int): The maximum number of items to get.
+        - claim (boolean): Whether or not to claim the items at the same time.
+
+        Returns: List of dicts with the "wiki" and "date" of each item.
+        """
+        items = []
+        conds = self.getJobConds(job=job)
+        if (conds is None):
+            return items
+
+        if (claim):
+            columns = ['wiki', self.dumpdatecolumn]
+            try:
+                results = self.sqldb.popAndClaim(dbtable=self.dbtable,
+                                                 columns=columns,
+                                                 conds=' AND '.join(conds),
+                                                 limit=limit)
+            except Exception as exception:
+                # Do not mistake a database error for having no items left
+                self.common.giveMessage("Unable to claim items for the %s "
+                                        "job: %s" % (job, exception))
+                raise
         else:
+            results = self.sqldb.select(dbtable=self.dbtable,
+                                        columns=['wiki', self.dumpdatecolumn],
+                                        conds=' AND '.join(conds),
+                                        options='LIMIT %d' % (limit))
+        if results is not None:
             for result in results:
-                output = {
+                items.append({
                     'wiki': result[0],
-                    'date': result[1].strftime("%Y%m%d")
-                }
-
-        return output
+                    'date': result[1]
+                })
+        return items
 
-    def updateCanArchive(self, params, can_archive):
+    def queueMark(self, mark, params):
         """
-        This function is used to update the status of whether a dump can be
-        archived.
+        This function is used to buffer a mark for an item, which will be
+        written to the database together with other marks by flushMarks.
 
-        - params (dict): Information about the item with the keys "wiki",
-        "dumpdate" and "can_archive".
-        - can_archive (int): Whether or not the item can be archived.
-
-        Returns: True if update is successful, False if an error occurred.
+        - mark (string): The mark to give, one of the keys of self.marks.
+        - params (dict): Information about the item with the keys "wiki" and
+        "dumpdate".
         """
-        vals = {
-            'can_archive': '"%s"' % (can_archive)
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        self.pendingmarks.setdefault(mark, []).append(params)
 
-    def markArchived(self, params):
+    def flushMarks(self, force=True):
         """
-        This function is used to mark an item as archived after doing so.
+        This function is used to write all buffered marks to the database,
+        with one transaction for each type of mark. The claims on the items
+        are released at the same time.
 
-        - params (dict): Information about the item with the keys "wiki"
-        and "dumpdate".
+        - force (boolean): Whether or not to write the marks even if there
+        are fewer than self.markbatch of them and they were last written less
+        than a minute ago.
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_archived': '"1"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        pending = sum([len(items) for items in self.pendingmarks.values()])
+        if (pending == 0):
+            return True
+        elif (not force and pending < self.markbatch and
+              time.time() - self.marksflushed < 60):
+            return True
+
+        status = True
+        # Copy the marks as they are removed from the dict along the way
+        for mark, items in list(self.pendingmarks.items()):
+            column, value = self.marks[mark]
+            rows = [(value, None, item['wiki'], item['dumpdate'])
+                    for item in items]
+            if (self.sqldb.updateMany(dbtable=self.dbtable,
+                                      columns=[column, 'claimed_by'],
+                                      keys=['wiki', 'dumpdate'], rows=rows)):
+                del self.pendingmarks[mark]
+            else:
+                status = False
+        self.marksflushed = time.time()
+        return status
 
-    def markChecked(self, params):
+    def releaseClaims(self):
         """
-        This function is used to mark an item as checked after doing so.
-
-        - params (dict): Information about the item with the keys "wiki"
-        and "dumpdate".
+        This function is used to release the items that are still claimed by
+        this instance but have not been worked on, such as the rest of a batch
+        when the job is interrupted. Items waiting for their marks to be
+        written stay claimed.
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_checked': '"1"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        keep = [item for items in self.pendingmarks.values()
+                for item in items]
+        return self.sqldb.releaseClaims(dbtable=self.dbtable, keep=keep)
 
-    def markFailedArchive(self, params):
+    def addNewItems(self, items):
         """
-        This function is used to mark an item as failed when archiving it.
+        This function is used to insert many new items into the database in a
+        single transaction.
 
-        - params (dict): Information about the item with the keys "wiki"
-        and "dumpdate".
+        - items (list): A list of dicts with information about each item with
+        the keys "wiki" and "dumpdate".
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_archived': '"2"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        columns = ['wiki', 'dumpdate', 'claimed_by', 'can_archive',
+                   'is_archived', 'is_checked', 'comments']
+        rows = []
+        for item in items:
+            try:
+                arcdate = self.conv.getDateFromWiki(item['dumpdate'],
+                                                    archivedate=True)
+            except ValueError:
+                # This case occurs when the "dumpdate" parameter is not in the
+                # %Y%m%d format (usually for files like "dcatap.rdf")
+                continue
+            rows.append((item['wiki'], arcdate, None, 0, 0, 0, None))
+        return self.sqldb.insertMany(dbtable=self.dbtable, columns=columns,
+                                     rows=rows)
 
-    def markFailedCheck(self, params):
+    def updateCanArchives(self, items):
         """
-        This function is used to mark an item as failed when checking it.
+        This function is used to update the can_archive status of many dumps
+        in a single transaction.
 
-        - params (dict): Information about the item with the keys "wiki"
-        and "dumpdate".
+        - items (list): A list of dicts with the keys "wiki", "dumpdate" and
+        "can_archive".
 
         Returns: True if update is successful, False if an error occurred.
         """
-        vals = {
-            'is_checked': '"2"',
-            'claimed_by': 'NULL'
-        }
-        return self.sqldb.update(dbtable=self.dbtable, values=vals,
-                                 conds=self.sqldb.getConds(params=params))
+        rows = []
+        for item in items:
+            arcdate = self.conv.getDateFromWiki(item['dumpdate'],
+                                                archivedate=True)
+            rows.append((item['can_archive'], item['wiki'], arcdate))
+        return self.sqldb.updateMany(dbtable=self.dbtable,
+                                     columns=['can_archive'],
+                                     keys=['wiki', 'dumpdate'], rows=rows)
 
-    def addNewItem(self, params):
+    def getAllStoredDumps(self):
         """
-        This function is used to insert a new item into the database.
+        This function is used to get the can_archive statuses of all dumps of
+        all databases in a single query. The "update" job works on this
+        instead of querying the database for each database.
 
-        - params (dict): Information about the item with the keys "wiki" and
-        "dumpdate".
+        Returns: Dict with the databases as keys and a dict of the dump dates
+        (in %Y%m%d format) and their can_archive statuses as values.
+        """
+        stored = {}
+        results = self.sqldb.select(dbtable=self.dbtable,
+                                    columns=['wiki', self.dumpdatecolumn,
+                                             'can_archive'])
+        if results is not None:
+            for result in results:
+                dumps = stored.setdefault(result[0], {})
+                dumps[result[1]] = str(result[2])
+        return stored
 
-        Returns: True if update is successful, False if an error occurred.
+    @staticmethod
+    def filterStoredDumps(stored, can_archive="all"):
         """
-        try:
-            arcdate = self.conv.getDateFromWiki(params['dumpdate'],
-                                                archivedate=True)
-        except ValueError:
-            # This case occurs when the "dumpdate" parameter is not in the
-            # %Y%m%d format (usually for files like "dcatap.rdf")
-            return False
+        This function is used to filter the dumps of a database from
+        getAllStoredDumps (up to 30 of the latest dumps).
 
-        values = {
-            'wiki': '"%s"' % (params['wiki']),
-            'dumpdate': '"%s"' % (arcdate),
-            'claimed_by': 'NULL',
-            'can_archive': '"0"',
-            'is_archived': '"0"',
-            'is_checked': '"0"',
-            'comments': 'NULL'
-        }
-        return self.sqldb.insert(dbtable=self.dbtable, values=values)
+        - stored (dict): The dump dates and their can_archive statuses.
+        - can_archive (string): Dumps with this can_archive status will be
+        returned, "all" for all can_archive statuses.
 
-    def updateNewDumps(self, db, alldumps):
+        Returns: List of dump dates, starting from the latest dump.
         """
-        This function is used to check if all new dumps have been registered
-        and update the database accordingly for new dumps. This function is
-        called during the "update" job.
+        dumps = []
+        for dump in sorted(stored, reverse=True):
+            if (can_archive != "all" and stored[dump] != str(can_archive)):
+                continue
+            dumps.append(dump)
+            if (len(dumps) == 30):
+                break
+        return dumps
+
+    def updateNewDumps(self, db, alldumps, stored):
+        """
+        This function is used to check if all new dumps have been registered.
+        This function is called during the "update" job.
 
         - db (string): The database to work on.
         - alldumps (list): A list of all dumps.
+        - stored (dict): The stored dumps of the database.
+
+        Returns: List of new items to add to the database.
         """
-        storeddumps = self.getStoredDumps(database=db)
-        for dump in alldumps:
-            if (dump in storeddumps):
-                self.common.giveMessage("Dump of %s on %s already in the "
-                                        "database, skipping" % (db, dump))
-                continue
-            else:
-                self.common.giveMessage("Adding new item %s on "
-                                        "%s" % (db, dump))
-                params = {
-                    'wiki': db,
-                    'dumpdate': dump
-                }
-                self.addNewItem(params=params)
+        items = []
+        for dump in sorted(set(alldumps) - set(stored)):
+            self.common.giveMessage("Adding new item %s on %s" % (db, dump))
+            items.append({
+                'wiki': db,
+                'dumpdate': dump
+            })
+        return items
 
-    def updateCanArchiveStatus(self, db, alldumps):
+    def updateCanArchiveStatus(self, db, alldumps, stored):
         """
         This function is used for checking existing dumps that have been
-        completed and updates the database if these dumps are ready to be
-        archived. This function is called during the "update" job.
+        completed and are now ready to be archived. This function is called
+        during the "update" job.
 
         - db (string): The database to work on.
         - alldumps (list): A list of all dumps.
+        - stored (dict): The stored dumps of the database.
+
+        Returns: List of can_archive statuses to update.
         """
-        cannotarc = self.getStoredDumps(database=db, can_archive=0)
+        items = []
+        cannotarc = self.filterStoredDumps(stored, can_archive=0)
         lastweek = datetime.datetime.now()
         lastweek -= datetime.timedelta(days=7)
+        cutoff = lastweek.strftime("%Y%m%d")
+        available = set(alldumps)
         for dump in cannotarc:
-            if (dump <= lastweek.strftime("%Y%m%d") and dump in alldumps):
+            if (dump <= cutoff and dump in available):
                 # The dump is now suitable to be archived
                 self.common.giveMessage("Updating can_archive for %s "
                                         "on %s" % (db, dump))
-                params = {
+                items.append({
                     'wiki': db,
-                    'dumpdate': dump
-                }
-                self.updateCanArchive(params=params, can_archive=1)
-            else:
-                continue
+                    'dumpdate': dump,
+                    'can_archive': 1
+                })
+        return items
 
-    def updateOldCanArchiveStatus(self, db, alldumps):
+    def updateOldCanArchiveStatus(self, db, alldumps, stored):
         """
         This function is used for checking whether the dumps marked as "can
         archive" is really able to be archived or has been deleted. This
         function is called during the "update" job.
 
         - db (string): The database to work on.
+        - alldumps (list): A list of all dumps.
+        - stored (dict): The stored dumps of the database.
+
+        Returns: List of can_archive statuses to update.
         """
-        canarc = self.getStoredDumps(database=db, can_archive=1)
+        items = []
+        canarc = self.filterStoredDumps(stored, can_archive=1)
+        available = set(alldumps)
         for dump in canarc:
-            if (dump in alldumps):
-                continue
-            else:
+            if (dump not in available):
                 # The dump is now unable to be archived
                 self.common.giveMessage("Updating can_archive for %s on "
                                         "%s" % (db, dump))
-                params = {
+                items.append({
                     'wiki': db,
-                    'dumpdate': dump
-                }
-                self.updateCanArchive(params=params, can_archive=0)
+                    'dumpdate': dump,
+                    'can_archive': 0
+                })
+        return items
 
     def getFilesToUpload(self, database, dumpdate):
         """
@@ -496,7 +506,7 @@ class BALMWikidata(object):
         allfiles = self.getFiles(database, dumpdate)
         if self.resume:
             items = []
-            iafiles = iaitem.getFileList()
+            iafiles = iaitem.getFileSet()
             for dumpfile in allfiles:
                 if dumpfile in iafiles:
                     continue
@@ -532,21 +542,87 @@ class BALMWikidata(object):
         dumps = "%s/%s/%s" % (self.config.get('dumpdir'), database, dumpdate)
         baseurl = "%s/%s/%s" % (self.config.get('baseurl'), database, dumpdate)
 
-        for thefile in items:
-            templist = [thefile]
-            os.system("mkdir -p %s && cd %s && rsync -avzP rsync://ftpmirror.your.org/wikimedia-dumps/other/wikibase/%s/%s/%s ." % (dumps, dumps, database, dumpdate, thefile))
-            # self.common.downloadFiles(filelist=templist, directory=dumps, baseurl=baseurl)
-
-            if (self.common.checkDumpDir(path=dumps, filelist=templist)):
-                pass
-            else:
-                # The dump directory is not suitable to be used, exit the function
-                return False
-
-            os.chdir(dumps)
-            upload = iaitem.upload(body=templist, metadata=md, headers=headers)
-            if upload:
-                shutil.rmtree(dumps)
+        def download():
+            # Keep downloading the files one after another while the files
+            # that have been downloaded are being uploaded
+            for thefile in items:
+                slots.acquire()
+                if (stop.is_set()):
+                    break
+                templist = [thefile]
+                os.system("mkdir -p %s && cd %s && rsync -avzP rsync://ftpmirror.your.org/wikimedia-dumps/other/wikibase/%s/%s/%s ." % (dumps, dumps, database, dumpdate, thefile))
+                # self.common.downloadFiles(filelist=templist, directory=dumps, baseurl=baseurl)
+                downloaded.put((thefile, self.common.checkDumpDir(
+                    path=dumps, filelist=templist)))
+            downloaded.put((None, True))
+
+        def upload(thefile, metadata=None):
+            try:
+                if (iaitem.upload(body=[thefile], metadata=metadata,
+                                  headers=headers, path=dumps)):
+                    # Other files may still be in the directory
+                    os.remove(os.path.join(dumps, thefile))
+                    return True
+                else:
+                    return False
+            finally:
+                slots.release()
+
+        if (items == []):
+            return True
+        workers = int(self.config.get('uploadworkers', default=4))
+        # Limit the number of files in the dump directory at the same time
+        slots = threading.Semaphore(workers + 1)
+        downloaded = queue.Queue()
+        stop = threading.Event()
+        downloader = threading.Thread(target=download)
+        downloader.daemon = True
+        downloader.start()
+        pool = ThreadPool(processes=workers)
+        complete = True
+        first = True
+        results = []
+        try:
+            while True:
+                # Waiting with a timeout allows KeyboardInterrupt to be raised
+                thefile, available = downloaded.get(True, 60*60*24*7)
+                if (thefile is None):
+                    break
+                elif not (available):
+                    # The dump directory is not suitable to be used, exit the
+                    # function
+                    complete = False
+                    break
+                elif (first):
+                    # The first file creates the item with its metadata, the
+                    # rest of the files can then be uploaded at the same time
+                    first = False
+                    if not (upload(thefile, metadata=md)):
+                        # The other files must not create the item without
+                        # its metadata
+                        complete = False
+                        break
+                else:
+                    results.append(pool.apply_async(upload, (thefile,)))
+        finally:
+            # Do not start any more downloads
+            stop.set()
+            slots.release()
+            pool.close()
+            pool.join()
+            downloader.join()
+        shutil.rmtree(dumps, ignore_errors=True)
+        for result in results:
+            try:
+                if not (result.get()):
+                    complete = False
+            except Exception as exception:
+                # Do not lose errors raised in the upload threads
+                self.common.giveMessage("Error uploading to %s: %s" %
+                                        (identifier, exception))
+                complete = False
+        if not (complete):
+            return False
 
         #if (path is None):
         #    dumps = "%s/%s/%s" % (self.config.get('dumpdir'), database,
@@ -592,7 +668,7 @@ class BALMWikidata(object):
         identifier = "wikibase-%s-%s" % (database, dumpdate)
         iaitem = balchivist.BALArchiver(identifier=identifier,
                                         verbose=self.verbose, debug=self.debug)
-        iafiles = iaitem.getFileList()
+        iafiles = iaitem.getFileSet()
         self.common.giveMessage("Checking if all files are uploaded for %s "
                                 "on %s" % (database, dumpdate))
         for dumpfile in allfiles:
@@ -612,59 +688,64 @@ class BALMWikidata(object):
         occurred.
         """
         databases = self.getDatabases()
-        for db in databases:
-            alldumps = self.getDumpDates(database=db)
+        allstored = self.getAllStoredDumps()
+        # The directory listings are independent of each other, so fetch them
+        # all at once
+        dumpdates = self.common.parallelMap(self.getDumpDates, databases,
+                                            workers=self.workers)
+        newitems = []
+        canarchives = []
+        for db, alldumps in zip(databases, dumpdates):
+            stored = allstored.get(db, {})
             # Step 1: Ensure that all new dumps are registered
-            self.updateNewDumps(db, alldumps=alldumps)
+            newitems += self.updateNewDumps(db, alldumps=alldumps,
+                                            stored=stored)
             # Step 2: Check if the dump is suitable for archiving
-            self.updateCanArchiveStatus(db, alldumps=alldumps)
+            canarchives += self.updateCanArchiveStatus(db, alldumps=alldumps,
+                                                       stored=stored)
             # Step 3: Reset the can_archive statuses of old dumps
-            self.updateOldCanArchiveStatus(db, alldumps=alldumps)
+            canarchives += self.updateOldCanArchiveStatus(db,
+                                                          alldumps=alldumps,
+                                                          stored=stored)
 
+        # Write all changes in one transaction per step
+        self.addNewItems(newitems)
+        self.updateCanArchives(canarchives)
         return True
 
-    def dispatch(self, job, wiki, date, path):
+    def dispatch(self, job, wiki, date, path, claimed=False):
         """
         This function is for dispatching an item to the various functions.
+
+        - claimed (boolean): Whether or not the item has already been claimed
+        by this instance.
         """
+        if (job not in self.jobmarks):
+            return False
+
         updatedetails = {
             'wiki': wiki,
             'dumpdate': self.conv.getDateFromWiki(date, archivedate=True)
         }
 
         # Claim the item from the database server if not in debug mode
-        if self.debug:
-            pass
-        else:
+        if not (self.debug or claimed):
             self.sqldb.claimItem(params=updatedetails, dbtable=self.dbtable)
 
-        msg = "Running %s on the JSON dumps of all Wikibase entries " % (job)
-        msg += "for %s on %s" % (wiki, date)
-        self.common.giveMessage(msg)
         if (job == "archive"):
             status = self.archive(database=wiki, dumpdate=date, path=path)
-            if (self.debug):
-                return status
-            elif (self.debug is False and status):
-                self.common.giveMessage("Marking %s on %s as archived" %
-                                        (wiki, date))
-                self.markArchived(updatedetails)
-            else:
-                self.common.giveMessage("Marking %s on %s as failed"
-                                        " archive" % (wiki, date))
-                self.markFailedArchive(updatedetails)
-        elif (job == "check"):
+        else:
             status = self.check(database=wiki, dumpdate=date)
-            if (self.debug):
-                return status
-            elif (self.debug is False and status):
-                self.common.giveMessage("Marking %s on %s as checked" %
-                                        (wiki, date))
-                self.markChecked(updatedetails)
-            else:
-                self.common.giveMessage("Marking %s on %s as failed"
-                                        " check" % (wiki, date))
-                self.markFailedCheck(updatedetails)
+        success, failure = self.jobmarks[job]
+        mark = success if status else failure
+
+        # Give a single message for each item after it has been worked on
+        self.common.giveMessage("Ran %s on the JSON dumps of all Wikibase "
+                                "entries for %s on %s: %s" % (job, wiki, date,
+                                                              mark))
+        if (self.debug):
+            return status
+        self.queueMark(mark, updatedetails)
 
     def execute(self, args=None):
         """
@@ -701,16 +782,38 @@ class BALMWikidata(object):
                 wikidatajob = args.wikidatajob
                 wikidatapath = args.wikidatapath
 
-            while self.getItemsLeft(job=wikidatajob) > 0:
-                itemdetails = self.getRandomItem(job=wikidatajob)
-                wiki = itemdetails['wiki']
-                date = itemdetails['date']
-                self.dispatch(job=wikidatajob, wiki=wiki, date=date,
-                              path=wikidatapath)
+            if (self.debug):
+                # Nothing is claimed or marked in debug mode, so the same
+                # items would keep coming back. Go through them once.
+                for item in self.getPendingItems(job=wikidatajob):
+                    self.dispatch(job=wikidatajob, wiki=item['wiki'],
+                                  date=item['date'], path=wikidatapath)
+                return True
+
+            # Claim and get a batch of items at a time instead of counting and
+            # picking an item for each one
+            try:
+                while True:
+                    # Items claimed by this process stay claimed until their
+                    # marks are written, so write them before claiming more
+                    self.flushMarks()
+                    batch = self.getPendingItems(job=wikidatajob, claim=True)
+                    for item in batch:
+                        self.dispatch(job=wikidatajob, wiki=item['wiki'],
+                                      date=item['date'], path=wikidatapath,
+                                      claimed=True)
+                    if (batch == []):
+                        break
+            finally:
+                # Do not leave any items claimed when exiting, including the
+                # rest of the batch if the job was interrupted
+                self.flushMarks()
+                self.releaseClaims()
         else:
             self.resume = args.wikidataresume
             self.dispatch(job=args.wikidatajob, wiki=args.wikidatawiki,
                           date=args.wikidatadate, path=args.wikidatapath)
+            self.flushMarks()
 
         return True
 
@@ -12,3 +12,4 @@ CREATE TABLE wikidata (
 
 CREATE INDEX is_archived ON wikidata (is_archived);
 CREATE INDEX is_checked ON wikidata (is_checked);
+CREATE INDEX pending ON wikidata (claimed_by, is_archived, can_archive, is_checked);
@@ -15,14 +15,23 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import datetime
+import importlib
 import json
+import signal
 import time
 
 import balchivist
-import modules
 
 
 class BALRunner(object):
+    # The maximum number of seconds to sleep between each pass
+    sleeptime = 60*60*6
+    # The message given before sleeping, with the current time
+    sleepmessage = "Sleeping for 6 hours, %s"
+    # Decoded lists of modules, keyed by the raw configuration value
+    modulelists = {}
+
     def __init__(self):
         """
         This script is the main runner script that will call the individual
@@ -31,17 +40,63 @@ class BALRunner(object):
         """
         config = balchivist.BALConfig('main')
         self.sqldb = balchivist.BALSqlDb.getFromConf()
-        self.modules = json.loads(config.get('modules'))
+        self.modules = self.getModules(config=config)
         self.message = balchivist.BALMessage()
+        # The number of modules to run at the same time
+        self.moduleworkers = int(config.get('moduleworkers',
+                                            max(len(self.modules), 1)))
+        # The names of the classes of each module
+        self.classnames = {module: "BALM" + module.title()
+                           for module in self.modules}
+        # The module classes, imported when they are first needed
+        self.classes = {}
+        # The module instances, kept across passes of the main loop
+        self.handlers = {}
+        # The command line parser, built when it is first needed
+        self.parser = None
+        # Sending SIGUSR1 to the runner ends its sleep early
+        self.wakeup = False
+        if (hasattr(signal, 'SIGUSR1')):
+            signal.signal(signal.SIGUSR1, self.wake)
+
+    @classmethod
+    def getModules(cls, config):
+        """
+        This function is used to get the list of modules to use from the
+        configuration. The list is only decoded again if the value changes.
+
+        - config (BALConfig object): The configuration for the main section.
+
+        Returns: Tuple of module names in the configured order, with any
+        duplicates removed.
+        """
+        value = config.get('modules')
+        modules = cls.modulelists.get(value)
+        if (modules is None):
+            seen = set()
+            modules = []
+            for module in json.loads(value):
+                # A module listed twice would otherwise run twice at once
+                if (module not in seen):
+                    seen.add(module)
+                    modules.append(module)
+            modules = tuple(modules)
+            cls.modulelists[value] = modules
+        return modules
 
     def parseArguments(self):
         """
         This function is for parsing the command line arguments passed by the
-        user into the script.
+        user into the script. The parser is only built once.
+
+        Returns: ArgumentParser object with the arguments of all modules.
         """
+        if (self.parser is not None):
+            return self.parser
+
         IncorrectUsage = balchivist.exception.IncorrectUsage
         version = balchivist.BALVERSION
-        types = self.modules + ["maintenance"]
+        types = self.modules + ("maintenance",)
         # Main parser for all generic arguments
         parser = argparse.ArgumentParser(
             description="A Python library for archiving datasets to the "
@@ -77,19 +132,87 @@ class BALRunner(object):
                                  "not intend to run the script forever.")
 
         # Declare all the necessary arguments used by each individual modules
-        if (self.modules == list()):
+        if (not self.modules):
             # There are no modules listed, exit the script now
             msg = self.message.getMessage('exception-nomodules')
             raise IncorrectUsage(msg)
-        else:
-            pass
 
         for module in self.modules:
-            classname = "BALM" + module.title()
-            getattr(modules, classname).argparse(parser=parser)
+            self.getClass(module=module).argparse(parser=parser)
 
+        self.parser = parser
         return parser
 
+    def wake(self, signum, frame):
+        """
+        This function is used as the signal handler for waking the runner up
+        from its sleep between passes.
+
+        - signum (int): The number of the signal received.
+        - frame (frame): The stack frame that was interrupted.
+        """
+        self.wakeup = True
+
+    def sleep(self):
+        """
+        This function is used to sleep until the next pass is due or until
+        the runner is woken up with SIGUSR1, whichever comes first.
+        """
+        end = time.time() + self.sleeptime
+        while (not self.wakeup):
+            remaining = end - time.time()
+            if (remaining <= 0):
+                break
+            # The signal interrupts the sleep on Python 2, sleeping in short
+            # steps ensures that it is still noticed on later versions
+            time.sleep(min(remaining, 60))
+        self.wakeup = False
+
+    def getClass(self, module):
+        """
+        This function is used to get the class of the given module. Only the
+        modules that are actually used are imported.
+
+        - module (string): The name of the module.
+
+        Returns: The module class.
+        """
+        ClassModule = self.classes.get(module)
+        if (ClassModule is None):
+            imported = importlib.import_module("modules." + module)
+            ClassModule = getattr(imported, self.classnames[module])
+            self.classes[module] = ClassModule
+        return ClassModule
+
+    def getHandler(self, module, params):
+        """
+        This function is used to get the instance of the given module. The
+        instance is created on first use and reused afterwards.
+
+        - module (string): The name of the module.
+        - params (dict): The parameters to pass to the module.
+
+        Returns: The instance of the module class.
+        """
+        handler = self.handlers.get(module)
+        if (handler is None):
+            handler = self.getClass(module=module)(params=params,
+                                                   sqldb=self.sqldb)
+            self.handlers[module] = handler
+        return handler
+
+    def runModule(self, module, params):
+        """
+        This function is used to run a single module with its default job.
+
+        - module (string): The name of the module to run.
+        - params (dict): The parameters to pass to the module.
+
+        Returns: True if the module ran successfully, False if otherwise.
+        """
+        ClassModule = self.getHandler(module=module, params=params)
+        return ClassModule.execute()
+
     def execute(self):
         """
         This function is the main execution function for the archiving scripts.
@@ -103,29 +226,28 @@ class BALRunner(object):
             "verbose": args.verbose,
             "debug": args.debug
         }
+        # Running a single module or the maintenance tasks only needs one pass
+        if (args.module == "maintenance"):
+            BALMaintenance = balchivist.BALMaintenance(params=params,
+                                                       sqldb=self.sqldb)
+            BALMaintenance.execute()
+            return
+        elif (args.module is not None):
+            ClassModule = self.getHandler(module=args.module, params=params)
+            ClassModule.execute(args=args)
+            return
+
+        # Create the module instances before running them in parallel
+        for module in self.modules:
+            self.getHandler(module=module, params=params)
+
         while True:
-            if (args.module is not None) and (args.module != "maintenance"):
-                classtype = "BALM" + args.module.title()
-                ClassModule = getattr(modules, classtype)(params=params,
-                                                          sqldb=self.sqldb)
-                ClassModule.execute(args=args)
-                break
-            elif (args.module == "maintenance"):
-                BALMaintenance = balchivist.BALMaintenance(params=params,
-                                                           sqldb=self.sqldb)
-                BALMaintenance.execute()
-                break
-            else:
-                for module in self.modules:
-                    classtype = "BALM" + module.title()
-                    ClassModule = getattr(modules, classtype)(params=params,
-                                                              sqldb=self.sqldb)
-                    status = ClassModule.execute()
-                    if (status):
-                        continue
-                    else:
-                        # An error has occurred, exit immediately
-                        break
+            # The modules work on separate datasets, so run them at the same
+            # time and stop starting new ones when one fails
+            common.parallelAll(
+                lambda module: self.runModule(module=module, params=params),
+                self.modules, workers=self.moduleworkers
+            )
 
             # Determine if we should exit the script now
             if (args.debug):
@@ -136,9 +258,11 @@ class BALRunner(object):
                 break
             else:
                 # Allow the script to sleep for 6 hours
-                timenow = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                common.giveMessage("Sleeping for 6 hours, %s" % (timenow))
-                time.sleep(60*60*6)
+                timenow = datetime.datetime.now().replace(microsecond=0)
+                common.giveMessage(self.sleepmessage % (timenow))
+                # Do not hold an idle connection to the database while asleep
+                self.sqldb.close()
+                self.sleep()
 
 
 if __name__ == '__main__':